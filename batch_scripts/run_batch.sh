@@ -0,0 +1,8 @@
+#!/bin/bash
+# Set up free surfer
+echo "Setting up FreeSurfer..."
+export FREESURFER_HOME=/home/pmahon/research/INN/software/freesurfer/7.4.1
+source $FREESURFER_HOME/SetUpFreeSurfer.sh
+. /opt/miniconda3/bin/activate mne
+# Run pipeline on all subjects
+python ./tvb-ccmeg/run_batch.py $PIPELINE $SUBJECT_LIST $N_WORKERS
@@ -0,0 +1,51 @@
+#!/bin/bash
+#SBATCH --output=./logs/pipeline/output/batch_output_%j.out
+#SBATCH --error=./logs/pipeline/error/batch_error_%j.err
+#SBATCH --nodes=1
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task=32
+#SBATCH --time=24:00:00
+#SBATCH --mem=0
+#SBATCH --account=rrg-rmcintos
+
+# submit_batch.sh is used to process a whole list of subjects in one job on one
+# node, several subjects at a time, instead of one job per subject.
+#
+# Usage:
+#	sbatch ./batch_scripts/submit_batch.sh <pipeline_environment.sif> <pipeline_repo> <beamformer|mne> <subject_list.txt> <n_workers>
+#
+# The cores requested with --cpus-per-task are divided between the n_workers
+# subjects processed at once. --mem=0 requests all the memory of the node, each
+# subject needs up to ~48G, so choose n_workers to fit the node. A subject that
+# fails does not stop the others, the list of failed subjects is printed at the
+# end of the output log.
+
+if [ $# -ne 5 ]; then
+    echo "Usage: $0 <pipeline_environment.sif> <pipeline_repo> <beamformer|mne> <subject_list.txt> <n_workers>"
+    exit 1
+fi
+
+PIPELINE_ENVIRONMENT=$1
+PIPELINE_REPO=$2
+export PIPELINE=$3
+export SUBJECT_LIST=$4
+export N_WORKERS=$5
+
+# Check if the file exists
+if [ ! -f "$SUBJECT_LIST" ]; then
+    echo "File not found: $SUBJECT_LIST"
+    exit 1
+fi
+
+# Create processed_meg output repository
+mkdir -p "$(pwd)/_Data/processed_meg"
+
+# Set up free surfer
+echo "Setting up FreeSurfer..."
+export FREESURFER_HOME=/home/pmahon/research/INN/software/freesurfer/7.4.1
+source $FREESURFER_HOME/SetUpFreeSurfer.sh
+
+echo "Running pipeline..."
+echo "Pipeline Environment:	$PIPELINE_ENVIRONMENT"
+module load apptainer
+singularity exec --bind $FREESURFER_HOME:$FREESURFER_HOME --bind /home:/home --bind /project:/project --bind /scratch:/scratch --bind /localscratch:/localscratch "$PIPELINE_ENVIRONMENT" ./batch_scripts/run_batch.sh
@@ -0,0 +1,42 @@
+#!/bin/bash
+#SBATCH --output=./logs/benchmark/benchmark_output_%j.out
+#SBATCH --error=./logs/benchmark/benchmark_error_%j.err
+#SBATCH --nodes=1
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task=32
+#SBATCH --exclusive
+#SBATCH --time=12:00:00
+#SBATCH --mem=0
+#SBATCH --account=rrg-rmcintos
+
+# submit_benchmark.sh runs benchmark_suite.py on a whole compute node, either to
+# save the baseline (save) or to compare with it (compare).
+#
+# Usage:
+#	sbatch ./batch_scripts/submit_benchmark.sh <pipeline_environment.sif> <save|compare> [benchmark_suite.py arguments]
+#
+# --exclusive keeps other jobs off the node, so that the times are comparable
+# between runs. The baseline is saved to tvb-ccmeg/benchmark_baseline.json with
+# every case and 5 runs per case. Compare on the same kind of node, the times
+# are then checked too (--fail-on-time).
+
+if [ $# -lt 2 ]; then
+    echo "Usage: $0 <pipeline_environment.sif> <save|compare> [benchmark_suite.py arguments]"
+    exit 1
+fi
+
+PIPELINE_ENVIRONMENT=$1
+MODE=$2
+shift 2
+
+case "$MODE" in
+    save) ARGS="--save --repeat 5";;
+    compare) ARGS="--fail-on-time";;
+    *) echo "Unknown mode: $MODE"; exit 1;;
+esac
+
+echo "Running benchmark..."
+echo "Pipeline Environment:	$PIPELINE_ENVIRONMENT"
+module load apptainer
+singularity exec --bind /home:/home --bind /project:/project --bind /scratch:/scratch --bind /localscratch:/localscratch "$PIPELINE_ENVIRONMENT" \
+    bash -c '. /opt/miniconda3/bin/activate mne && python ./tvb-ccmeg/benchmark_suite.py "$@"' benchmark $ARGS "$@"
@@ -0,0 +1,106 @@
+#!/bin/env python
+#
+# Module name: aggregate_profiles.py
+#
+# Description: Script to summarize the per-subject stage profiles (profile.json) across a subject
+#              list: time and memory percentiles per stage, outlier subjects, and stages whose
+#              memory use gets close to the SLURM memory limit
+#
+# License: Apache 2.0
+
+import profiling        # Module with functions to record the time and memory used by each stage
+import run_batch        # Script to process a list of subjects in one job, reads the subject lists
+import numpy as np      # Need for array operations
+import json
+import os
+import sys
+
+if len(sys.argv) <= 2:
+    raise ValueError("A processed data directory and a subject list have not been provided. Usage:"
+                     "\n\tpython aggregate_profiles.py <processed_meg_dir> <subject_list.txt> [<mem_limit_GB>]")
+processed_dir = sys.argv[1]
+subjects = run_batch.read_subject_list(sys.argv[2])   # Same subject lists as run_batch.py
+mem_limit = float(sys.argv[3]) * 1e9 if len(sys.argv) > 3 else 64e9     # --mem=64G in the batch scripts
+warn_fraction = 0.8     # Flag stages projected to use more than this fraction of the limit
+
+# stage -> list of (subject, record); a stage run more than once for a subject (e.g. parcellation) is summed,
+# times and CPU times alike so the CPU efficiency stays CPU time / (wall time x cores), with the largest peak
+stages = dict()
+totals = []
+missing = []
+for subject in subjects:
+    fname = os.path.join(processed_dir, subject, 'profile.json')
+    if not os.path.isfile(fname):
+        missing.append(subject)
+        continue
+    merged = dict()
+    for record in profiling.read_profile(fname)['stages']:
+        if record.get('failed'):
+            continue
+        if record['stage'] in merged:
+            stage = merged[record['stage']]
+            stage['wall_time'] += record['wall_time']
+            stage['cpu_time'] += record['cpu_time']
+            stage['peak_rss'] = max(stage['peak_rss'], record['peak_rss'])
+            if stage.get('n_cpu') and stage['wall_time'] > 0:
+                stage['cpu_efficiency'] = stage['cpu_time'] / (stage['wall_time'] * stage['n_cpu'])
+        else:
+            merged[record['stage']] = dict(record)
+    for name, record in merged.items():
+        stages.setdefault(name, []).append((subject, record))
+    totals.append((subject, sum(record['wall_time'] for record in merged.values()),
+                   max([record['peak_rss'] for record in merged.values()] or [0])))
+
+def outliers(values):
+    # Indices of values far above the rest (beyond the upper quartile + 3 interquartile ranges)
+    q1, q3 = np.percentile(values, [25, 75])
+    return np.flatnonzero(values > q3 + 3 * (q3 - q1))
+
+def projected_peak(values):
+    # Robust projection of the worst case across a cohort: median + 4 scaled median absolute deviations,
+    # or the largest value seen if that is higher
+    median = np.median(values)
+    mad = 1.4826 * np.median(np.abs(values - median))
+    return max(median + 4 * mad, values.max())
+
+summary = dict(n_subjects=len(subjects), n_profiles=len(totals), missing=missing, mem_limit=mem_limit, stages=dict())
+print('%d of %d subjects have a profile\n' % (len(totals), len(subjects)))
+print('%-14s %5s  %27s  %27s  %6s' % ('stage', 'n', 'wall time (s) p50/p90/max', 'peak RSS (GB) p50/p90/max', 'CPU'))
+for name, entries in stages.items():
+    wall = np.array([record['wall_time'] for subject, record in entries])
+    rss = np.array([record['peak_rss'] for subject, record in entries])
+    efficiency = [record['cpu_efficiency'] for subject, record in entries if record.get('cpu_efficiency') is not None]
+    stage_summary = dict(n=len(entries),
+                         wall_time=dict(zip(('p50', 'p90', 'max'), np.percentile(wall, [50, 90, 100]).tolist())),
+                         peak_rss=dict(zip(('p50', 'p90', 'max'), np.percentile(rss, [50, 90, 100]).tolist())),
+                         cpu_efficiency=float(np.median(efficiency)) if efficiency else None,
+                         time_outliers=[entries[k][0] for k in outliers(wall)],
+                         memory_outliers=[entries[k][0] for k in outliers(rss)],
+                         projected_peak_rss=float(projected_peak(rss)))
+    stage_summary['memory_risk'] = bool(stage_summary['projected_peak_rss'] > warn_fraction * mem_limit)
+    summary['stages'][name] = stage_summary
+    print('%-14s %5d  %8.1f %8.1f %8.1f  %8.2f %8.2f %8.2f  %5.0f%%' % ((name, len(entries)) + tuple(np.percentile(wall, [50, 90, 100]))
+                                                                     + tuple(np.percentile(rss, [50, 90, 100]) / 1e9)
+                                                                     + (100 * (stage_summary['cpu_efficiency'] or 0),)))
+
+print('\nOutliers (beyond the upper quartile + 3 IQR):')
+for name, stage_summary in summary['stages'].items():
+    if stage_summary['time_outliers']:
+        print('  ' + name + ' time: ' + ' '.join(stage_summary['time_outliers']))
+    if stage_summary['memory_outliers']:
+        print('  ' + name + ' memory: ' + ' '.join(stage_summary['memory_outliers']))
+
+print('\nStages projected to use more than %d%% of the %.0f GB memory limit:' % (100 * warn_fraction, mem_limit / 1e9))
+for name, stage_summary in summary['stages'].items():
+    if stage_summary['memory_risk']:
+        print('  %s: %.1f GB projected' % (name, stage_summary['projected_peak_rss'] / 1e9))
+
+if totals:
+    wall = np.array([total for subject, total, peak in totals])
+    rss = np.array([peak for subject, total, peak in totals])
+    summary['subject_wall_time'] = dict(zip(('p50', 'p90', 'max'), np.percentile(wall, [50, 90, 100]).tolist()))
+    summary['subject_peak_rss'] = dict(zip(('p50', 'p90', 'max'), np.percentile(rss, [50, 90, 100]).tolist()))
+    print('\nWhole subject: %.0f / %.0f / %.0f s (p50/p90/max), peak %.1f GB' % (tuple(np.percentile(wall, [50, 90, 100])) + (rss.max() / 1e9,)))
+
+with open(os.path.join(processed_dir, 'profile_summary.json'), 'w') as outfile:
+    json.dump(summary, outfile, indent=1)
@@ -0,0 +1,48 @@
+#!/bin/env python
+#
+# Module name: benchmark_head_position.py
+#
+# Description: Script to measure the speedup of parallel cHPI head position estimation
+#              with the number of cores, to help size SLURM requests
+#
+# License: Apache 2.0
+
+import preprocess       # Module with all the preprocessing functions
+import numpy as np      # Need for array operations
+import os
+import sys
+import time
+
+if len(sys.argv) <= 1:
+    raise ValueError("A raw data file has not been provided. Usage:"
+                     "\n\tpython benchmark_head_position.py <raw_fname> [<n_jobs> ...]")
+raw_fname = sys.argv[1]
+# Numbers of cores to test, defaults to powers of two up to the cores available to this job
+if len(sys.argv) > 2:
+    n_jobs_list = [int(n_jobs) for n_jobs in sys.argv[2:]]
+else:
+    n_cpu = len(os.sched_getaffinity(0))
+    n_jobs_list = [2**i for i in range(int(np.log2(n_cpu)) + 1)]
+
+raw = preprocess.read_data(raw_fname)
+raw.del_proj()
+
+results = []
+for n_jobs in n_jobs_list:
+    start = time.perf_counter()
+    head_pos = preprocess.compute_head_position(raw, n_jobs=n_jobs)
+    results.append((n_jobs, time.perf_counter() - start, head_pos))
+
+# Report wall time, speedup and parallel efficiency relative to the first entry, plus the largest
+# difference in head position (mm) so the windowed fits can be checked against the reference
+# Rows are matched on their time (column 0), and each run must give the same time points
+ref_jobs, ref_time, ref_pos = results[0]
+print('n_jobs  time (s)  speedup  efficiency  max diff (mm)')
+for n_jobs, run_time, head_pos in results:
+    speedup = ref_time / run_time
+    rows = np.clip(np.searchsorted(ref_pos[:, 0], head_pos[:, 0]), 0, len(ref_pos) - 1)
+    if len(head_pos) != len(ref_pos) or not np.isclose(ref_pos[rows, 0], head_pos[:, 0]).all():
+        raise RuntimeError('Head positions with n_jobs=%d are not at the same time points as with n_jobs=%d '
+                           '(%d and %d time points)' % (n_jobs, ref_jobs, len(head_pos), len(ref_pos)))
+    max_diff = np.abs(head_pos[:, 4:7] - ref_pos[rows, 4:7]).max() * 1000
+    print('%6d  %8.1f  %7.2f  %10.2f  %13.3f' % (n_jobs, run_time, speedup, speedup * ref_jobs / n_jobs, max_diff))
@@ -0,0 +1,335 @@
+#!/bin/env python
+#
+# Module name: benchmark_suite.py
+#
+# Description: Script to time the functions of preprocess.py and compute_source.py on synthetic
+#              data (see synthetic.py) across recording lengths and channel counts, report their
+#              throughput and peak memory, and compare them with saved baselines
+#
+# License: Apache 2.0
+
+import mne              # Need MNE Python
+import preprocess       # Module with all the preprocessing functions
+import compute_source   # Module with functions to go from sensor space to source space
+import connectivity     # Module with functions to compute functional connectivity between parcels
+import synthetic        # Module with functions to build synthetic recordings and subjects
+import profiling        # Module with functions to record the time and memory used by each stage
+import numpy as np      # Need for array operations
+import argparse
+import fnmatch
+import functools
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+
+mne.set_log_level('error')
+
+# MEG channel sets: all Vectorview channels, gradiometers only (beamformer pipeline), magnetometers only
+CHANNELS = {'meg': 306, 'grad': 204, 'mag': 102}
+SUBJECT = 'synthetic'
+
+parser = argparse.ArgumentParser(description='Benchmark the pipeline functions on synthetic data. Exits with an '
+                                             'error if a case fails or uses more memory than its baseline (or is '
+                                             'slower, with --fail-on-time).')
+parser.add_argument('cases', nargs='*', default=['*'], help='Cases to run, as shell patterns (e.g. "filter*"), default all')
+parser.add_argument('--durations', type=float, nargs='+', default=[30., 120.], help='Recording lengths (s)')
+parser.add_argument('--channels', nargs='+', default=list(CHANNELS), choices=list(CHANNELS), help='MEG channel sets')
+parser.add_argument('--repeat', type=int, default=3, help='Runs per case, the fastest is kept (fewer if a case takes long)')
+parser.add_argument('--baseline', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json'),
+                    help='Baseline file, default the one saved next to this script')
+parser.add_argument('--save', action='store_true', help='Save the results as the new baseline instead of comparing')
+parser.add_argument('--time-tolerance', type=float, default=1.3, help='Largest accepted ratio of time to baseline')
+parser.add_argument('--memory-tolerance', type=float, default=1.3, help='Largest accepted ratio of peak memory to baseline')
+parser.add_argument('--fail-on-time', action='store_true', help='Exit with an error for slower cases too, not only list them '
+                                                                  '(only meaningful on the dedicated node the baseline was saved on)')
+parser.add_argument('--list', action='store_true', help='List the cases without running them')
+
+# Synthetic inputs, built once and only for the cases that are run
+workdir = tempfile.TemporaryDirectory(prefix='benchmark_suite_')
+
+def _fname(*parts):
+    return os.path.join(workdir.name, '_'.join(str(part) for part in parts))
+
+@functools.lru_cache(maxsize=None)
+def recording(duration, channels, sfreq=1000., chpi=False):
+    # Raw recording with EOG and ECG, and the same data saved to a file
+    raw = synthetic.make_raw(duration, sfreq=sfreq, picks=[channels, 'eog', 'ecg'], chpi=chpi)
+    raw_fname = _fname('raw', duration, channels, sfreq, chpi, 'raw.fif')
+    raw.save(raw_fname, overwrite=True)
+    return raw, raw_fname
+
+@functools.lru_cache(maxsize=None)
+def empty_room(duration, channels, sfreq=1000.):
+    er_raw = synthetic.make_raw(duration, sfreq=sfreq, picks=channels, seed=1)
+    er_fname = _fname('emptyroom', duration, channels, sfreq, 'raw.fif')
+    er_raw.save(er_fname, overwrite=True)
+    return er_raw, er_fname
+
+@functools.lru_cache(maxsize=None)
+def projected(duration, channels):
+    # Recording with heartbeat and blink projectors
+    raw, _ = recording(duration, channels)
+    raw, _ = preprocess.add_ecg_eog_projectors(raw.copy())
+    return raw
+
+@functools.lru_cache(maxsize=None)
+def bad_channels(duration, channels):
+    # Arguments of check_project_noise_cov: empty room recording and recording info with different bad channels
+    er_raw = empty_room(min(args.durations), channels)[0].copy()
+    er_raw.info['bads'] = [er_raw.ch_names[7], er_raw.ch_names[100]]
+    info = projected(duration, channels).info.copy()
+    info['bads'] = [info['ch_names'][5]]
+    return er_raw, info
+
+@functools.lru_cache(maxsize=None)
+def annotated(duration, channels):
+    # Recording with a BAD_ segment, for the cases checked against MNE's own functions
+    raw, _ = recording(duration, channels)
+    raw = raw.copy()
+    raw.set_annotations(mne.Annotations([duration / 3.], [duration / 10.], ['BAD_segment']))
+    return raw
+
+@functools.lru_cache(maxsize=None)
+def artifact_projectors(duration, channels):
+    raw = annotated(duration, channels)
+    return preprocess.compute_artifact_projectors(raw, *preprocess.find_artifact_events(raw))
+
+@functools.lru_cache(maxsize=None)
+def streaming_covariance(duration, channels):
+    # Arguments of check_streaming_covariance, with chunks and a start that don't line up with the annotation
+    raw = annotated(duration, channels)
+    return raw, preprocess.compute_streaming_covariance(raw, tmin=duration / 10., chunk_duration=duration / 7.), duration / 10.
+
+@functools.lru_cache(maxsize=None)
+def anatomy():
+    # Subject with surface and volume source spaces, BEM and the forward solution of the
+    # gradiometers, as in the beamformer pipeline (data at 500 Hz)
+    subjects_dir = _fname('freesurfer')
+    synthetic.make_subject(subjects_dir, SUBJECT)
+    src = compute_source.setup_source_space(SUBJECT, subjects_dir)
+    bem = compute_source.make_bem(SUBJECT, subjects_dir)
+    vol_src = mne.setup_volume_source_space(SUBJECT, pos=10., bem=bem, subjects_dir=subjects_dir)
+    raw, _ = recording(min(args.durations), 'grad', 500.)
+    fwd = mne.make_forward_solution(raw.info, synthetic.make_trans(), src, bem, meg=True, eeg=False, mindist=5.)
+    noise_cov = mne.compute_raw_covariance(empty_room(min(args.durations), 'grad', 500.)[0])
+    return dict(subjects_dir=subjects_dir, src=src, bem=bem, vol_src=vol_src, fwd=fwd, noise_cov=noise_cov)
+
+@functools.lru_cache(maxsize=None)
+def inverse_operator():
+    source = anatomy()
+    raw, _ = recording(min(args.durations), 'grad', 500.)
+    return mne.minimum_norm.make_inverse_operator(raw.info, source['fwd'], source['noise_cov'], loose=0.2, depth=0.8)
+
+@functools.lru_cache(maxsize=None)
+def beamformer():
+    # Same settings as the beamformer pipeline (reduced rank as the synthetic data has little structure)
+    source = anatomy()
+    raw, _ = recording(max(args.durations), 'grad', 500.)
+    data_cov = mne.compute_raw_covariance(raw)
+    return mne.beamformer.make_lcmv(raw.info, source['fwd'], data_cov, reg=0.05, pick_ori='max-power',
+                                    weight_norm='unit-noise-gain', rank='info', reduce_rank=True)
+
+# Beamformer settings compared in sweeps: the pipeline settings with three regularizations and two
+# weight normalizations, plus free orientation
+SWEEP = compute_source.lcmv_grid(reg=[0.01, 0.05, 0.1], weight_norm=['unit-noise-gain', 'nai'], pick_ori=['max-power'], rank=['info'])
+SWEEP += [dict(reg=0.05, pick_ori=None, weight_norm=None, rank=None)]
+
+@functools.lru_cache(maxsize=None)
+def sweep():
+    raw, _ = recording(max(args.durations), 'grad', 500.)
+    return compute_source.make_lcmv_sweep(raw.info, anatomy()['fwd'], mne.compute_raw_covariance(raw), SWEEP)
+
+@functools.lru_cache(maxsize=None)
+def label_reduction():
+    source = anatomy()
+    labels = mne.read_labels_from_annot(SUBJECT, parc='aparc', subjects_dir=source['subjects_dir'])
+    return compute_source.make_label_reduction(labels, source['src'], beamformer()['vertices'], SUBJECT)
+
+def output_dir():
+    # Fresh output (and cache) directory, so cached parcellation indices are not reused between runs
+    return tempfile.mkdtemp(dir=workdir.name)
+
+def sensor_cases(duration, channels):
+    # (name, size, number of input values (channels x samples), function returning the arguments, function)
+    # MEG channels plus 2 EOG and 1 ECG
+    size = dict(duration=duration, channels=channels)
+    n_values = (CHANNELS[channels] + 3) * int(duration * 1000)
+    rec = lambda: recording(duration, channels)[0].copy()
+    yield 'read_data', size, n_values, lambda: (recording(duration, channels)[1],), preprocess.read_data
+    yield 'filter_data', size, n_values, lambda: (rec(),), preprocess.filter_data
+    yield 'filter_resample_data', size, n_values, lambda: (rec(),), functools.partial(preprocess.filter_resample_data, sfreq=500.)
+    yield 'compute_streaming_covariance', size, n_values, lambda: (recording(duration, channels)[1],), preprocess.compute_streaming_covariance
+    yield 'check_streaming_covariance', size, n_values, lambda: streaming_covariance(duration, channels), preprocess.check_streaming_covariance
+    yield 'project_noise_cov', size, None, lambda: (mne.compute_raw_covariance(empty_room(min(args.durations), channels)[0]),
+                                                    projected(duration, channels).info), preprocess.project_noise_cov
+    yield 'check_project_noise_cov', size, None, lambda: bad_channels(duration, channels), preprocess.check_project_noise_cov
+    yield 'add_ecg_eog_projectors', size, n_values, lambda: (rec(),), preprocess.add_ecg_eog_projectors
+    yield 'add_ecg_projectors', size, n_values, lambda: (rec(),), preprocess.add_ecg_projectors
+    yield 'add_eog_projectors', size, n_values, lambda: (rec(),), preprocess.add_eog_projectors
+    yield 'check_artifact_projectors', size, n_values, lambda: (annotated(duration, channels), artifact_projectors(duration, channels)), preprocess.check_artifact_projectors
+    # do_ICA's default rejection thresholds, for the channel types in the recording
+    reject = {ch_type: value for ch_type, value in dict(mag=5e-12, grad=4000e-13).items() if channels in ('meg', ch_type)}
+    yield 'do_ICA', size, n_values, lambda: (rec(), mne.pick_types(recording(duration, channels)[0].info, meg=True), 'picard', reject), preprocess.do_ICA
+    if channels == 'meg':
+        # Maxwell filtering needs all the MEG channels
+        yield 'mark_bad_channels', size, n_values, lambda: (rec(),), preprocess.mark_bad_channels
+        yield 'maxwell_filter', size, n_values, lambda: (rec(), synthetic.calibration, synthetic.cross_talk), preprocess.maxwell_filter
+        yield 'compute_noise_cov', size, n_values, lambda: (empty_room(duration, channels)[1], projected(duration, channels),
+                                                            synthetic.calibration, synthetic.cross_talk), preprocess.compute_noise_cov
+        yield 'compute_head_position', size, n_values, lambda: (recording(duration, channels, chpi=True)[0],), preprocess.compute_head_position
+
+def source_cases(duration):
+    # Source space and forward model cases only depend on the anatomy, applying the inverse solutions
+    # and beamformers on the length of the recording (gradiometers at 500 Hz)
+    if duration == min(args.durations):
+        size = dict(sources='oct6')
+        yield 'setup_source_space', size, None, lambda: (SUBJECT, anatomy()['subjects_dir']), compute_source.setup_source_space
+        yield 'make_bem', size, None, lambda: (SUBJECT, anatomy()['subjects_dir']), compute_source.make_bem
+        yield 'make_inverse_operator', size, None, lambda: (recording(duration, 'grad', 500.)[0], recording(duration, 'grad', 500.)[1],
+                                                            synthetic.make_trans(), anatomy()['src'], anatomy()['bem'],
+                                                            anatomy()['noise_cov']), compute_source.make_inverse_operator
+        yield 'make_label_reduction', size, None, lambda: (mne.read_labels_from_annot(SUBJECT, parc='aparc', subjects_dir=anatomy()['subjects_dir']),
+                                                           anatomy()['src'], beamformer()['vertices'], SUBJECT), compute_source.make_label_reduction
+        yield 'make_parcellation_index', size, None, lambda: (anatomy()['src'], beamformer()['vertices'], SUBJECT, anatomy()['subjects_dir'],
+                                                              output_dir()), compute_source.make_parcellation_index
+        yield 'make_volume_parcellation_index', dict(sources='vol10mm'), None, lambda: (anatomy()['vol_src'], [anatomy()['vol_src'][0]['vertno']],
+                                                                                        os.path.join(anatomy()['subjects_dir'], SUBJECT, 'mri', 'aparc+aseg.mgz'),
+                                                                                        output_dir()), compute_source.make_volume_parcellation_index
+        yield 'make_fused_lcmv', size, None, lambda: (beamformer(), label_reduction()), compute_source.make_fused_lcmv
+        yield 'make_lcmv_sweep', dict(size, settings=len(SWEEP)), None, lambda: (recording(max(args.durations), 'grad', 500.)[0].info, anatomy()['fwd'],
+                                                                                 mne.compute_raw_covariance(recording(max(args.durations), 'grad', 500.)[0]),
+                                                                                 SWEEP), compute_source.make_lcmv_sweep
+    size = dict(duration=duration, sources='oct6')
+    n_values = (CHANNELS['grad'] + 3) * int(duration * 500)
+    raw = lambda: recording(duration, 'grad', 500.)[0]
+    yield 'compute_inverse_solution_rest', size, n_values, lambda: (raw(), inverse_operator(), 0, duration), compute_source.compute_inverse_solution_rest
+    def blocks():
+        # dSPM with pick_ori=None gives one time series per source, whatever the orientation constraint
+        sink = compute_source.array_sink(np.empty((inverse_operator()['nsource'], raw().n_times)))
+        return raw(), inverse_operator(), 0, duration, 10., sink
+    yield 'compute_inverse_solution_rest', dict(size, block_duration=10.), n_values, blocks, compute_source.compute_inverse_solution_rest
+    def parcel_blocks():
+        # As in the MNE pipeline: each block reduced to the Schaefer parcellation
+        src = inverse_operator()['src']
+        index = compute_source.make_parcellation_index(src, [s['vertno'] for s in src], SUBJECT, anatomy()['subjects_dir'], output_dir(),
+                                                       parcellations=dict(Schaefer=compute_source.PARCELLATIONS['Schaefer']), mode='mean')
+        sink = compute_source.parcellation_sink(np.empty((index['matrix'].shape[0], raw().n_times)), index)
+        return raw(), inverse_operator(), 0, duration, 10., sink
+    yield 'compute_inverse_solution_rest', dict(size, block_duration=10., sink='parcellation'), n_values, parcel_blocks, compute_source.compute_inverse_solution_rest
+    yield 'apply_fused_lcmv_raw', size, n_values, lambda: (raw(), compute_source.make_fused_lcmv(beamformer(), label_reduction()), beamformer()), compute_source.apply_fused_lcmv_raw
+    yield 'apply_lcmv_sweep_raw', dict(size, settings=len(SWEEP)), n_values, lambda: (raw(), sweep(), label_reduction()), compute_source.apply_lcmv_sweep_raw
+    def stc():
+        return (anatomy()['src'], mne.beamformer.apply_lcmv_raw(raw(), beamformer()), SUBJECT, anatomy()['subjects_dir'], output_dir(), False)
+    yield 'parcellate_source_data', size, n_values, stc, compute_source.parcellate_source_data
+    yield 'parcellate_fused_lcmv', size, n_values, lambda: (raw(), beamformer(), anatomy()['src'], SUBJECT, anatomy()['subjects_dir'], output_dir()), compute_source.parcellate_fused_lcmv
+    # Connectivity of 68 parcel time series (the aparc labels), whole recording and 60 s windows
+    parc_ts = lambda: np.random.RandomState(0).randn(68, int(duration * 500))
+    yield 'compute_connectivity', dict(duration=duration, parcels=68), 68 * int(duration * 500), lambda: (parc_ts(), 500.), connectivity.compute_connectivity
+    yield 'compute_connectivity', dict(duration=duration, parcels=68, window=60.), 68 * int(duration * 500), lambda: (parc_ts(), 500., connectivity.BANDS,
+                                                                                                                   connectivity.METRICS, 60.), connectivity.compute_connectivity
+
+def all_cases():
+    for duration in args.durations:
+        for channels in args.channels:
+            yield from sensor_cases(duration, channels)
+        yield from source_cases(duration)
+
+def case_key(name, size):
+    return name + '[' + ', '.join(str(key) + '=' + str(value) for key, value in size.items()) + ']'
+
+def run_case(prepare, function, repeat, max_time=30.):
+    # Times of up to repeat runs (stops early once max_time s have been spent) and the largest
+    # increase of the peak memory over the memory in use before the call
+    wall_times, memory = [], []
+    while len(wall_times) < repeat and sum(wall_times) < max_time:
+        arguments = prepare()
+        gc.collect()
+        with profiling.profile(function.__name__ if hasattr(function, '__name__') else 'case') as record:
+            function(*arguments)
+        del arguments
+        wall_times.append(record['wall_time'])
+        memory.append(record['peak_rss'] - record['start_rss'])
+    return wall_times, max(memory)
+
+def time_noise(wall_times):
+    # Spread of the times of the repeated runs of a case, 0 for baselines saved without them
+    return max(wall_times) - min(wall_times) if wall_times else 0.
+
+def environment():
+    # Baselines only make sense on the same kind of machine and software
+    return dict(machine=platform.machine(), processor=platform.processor(), n_cpu=len(os.sched_getaffinity(0)),
+                python=platform.python_version(), mne=mne.__version__, numpy=np.__version__)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    cases = [case for case in all_cases() if any(fnmatch.fnmatch(case[0], pattern) for pattern in args.cases)]
+    if args.list:
+        print('\n'.join(case_key(name, size) for name, size, _, _, _ in cases))
+        sys.exit(0)
+
+    baseline = None
+    if not args.save and os.path.isfile(args.baseline):
+        with open(args.baseline) as infile:
+            baseline = json.load(infile)
+        if baseline['environment'] != environment():
+            print('Warning: the baseline was saved on a different machine or software versions:\n' +
+                  json.dumps(baseline['environment']) + '\n')
+
+    results = dict()
+    regressions, slower, failures = [], [], []
+    print('%-75s %9s %10s %10s  %s' % ('case', 'time (s)', 'MS/s', 'peak (MB)', 'vs baseline'))
+    for name, size, n_values, prepare, function in cases:
+        key = case_key(name, size)
+        try:
+            wall_times, memory = run_case(prepare, function, args.repeat)
+        except Exception as error:
+            # Includes the check_* cases, which raise when a function differs from the MNE reference
+            print('%-75s failed: %s' % (key, repr(error)))
+            failures.append(key + ': ' + repr(error))
+            continue
+        wall_time = min(wall_times)
+        throughput = n_values / wall_time if n_values else None
+        results[key] = dict(wall_time=wall_time, wall_times=wall_times, memory=memory, throughput=throughput)
+        comparison = ''
+        if baseline is not None and key in baseline['cases']:
+            reference = baseline['cases'][key]
+            time_ratio = wall_time / reference['wall_time']
+            # Small absolute changes (timer noise, allocator behaviour) are not regressions: a case is
+            # only slower by more than the spread of the repeated runs, in the baseline and now
+            noise = max(0.05, 3 * (time_noise(reference.get('wall_times')) + time_noise(wall_times)))
+            memory_ratio = max(memory, 50e6) / max(reference['memory'], 50e6)
+            comparison = 'time x%.2f, memory x%.2f' % (time_ratio, memory_ratio)
+            if memory_ratio > args.memory_tolerance:
+                regressions.append(key + ': ' + comparison)
+                comparison += '  MORE MEMORY'
+            if time_ratio > args.time_tolerance and wall_time - reference['wall_time'] > noise:
+                (regressions if args.fail_on_time else slower).append(key + ': ' + comparison)
+                comparison += '  SLOWER'
+        print('%-75s %9.3f %10s %10.0f  %s' % (key, wall_time, '%.1f' % (throughput / 1e6) if throughput else '-', memory / 1e6, comparison))
+        sys.stdout.flush()
+
+    if args.save:
+        # Keep the baselines of cases that were not run this time
+        saved = dict(environment=environment(), cases=dict())
+        if os.path.isfile(args.baseline):
+            with open(args.baseline) as infile:
+                previous = json.load(infile)
+            if previous['environment'] == saved['environment']:
+                saved['cases'] = previous['cases']
+        saved['cases'].update(results)
+        with open(args.baseline, 'w') as outfile:
+            json.dump(saved, outfile, indent=1)
+        print('\nBaseline saved to ' + args.baseline)
+    elif baseline is None:
+        print('\nNo baseline to compare with, save one with --save')
+    if failures:
+        print('\nFailed cases:\n' + '\n'.join(failures))
+    if slower:
+        print('\nSlower than ' + args.baseline + ' (not an error without --fail-on-time):\n' + '\n'.join(slower))
+    if regressions:
+        print('\nRegressions against ' + args.baseline + ':\n' + '\n'.join(regressions))
+    if failures or regressions:
+        sys.exit(1)
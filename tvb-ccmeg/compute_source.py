@@ -10,12 +10,17 @@
 
 import mne
 import os
+import json
+import itertools
 import numpy as np
+import scipy.sparse
+import stage_cache
+import output_store
 
-def setup_source_space(subject, subjects_dir):
+def setup_source_space(subject, subjects_dir, n_jobs=None):
     # Requires BEM surfaces to be computed in FreeSurfer directory
     # Could compute BEM surfaces in this module (done in MNE Python, not FreeSurfer)
-    src = mne.setup_source_space(subject, spacing='oct6', surface='orig', add_dist=False, subjects_dir=subjects_dir)
+    src = mne.setup_source_space(subject, spacing='oct6', surface='orig', add_dist=False, subjects_dir=subjects_dir, n_jobs=n_jobs)
     return src
 
 def make_bem(subject, subjects_dir):
@@ -26,42 +31,400 @@ def make_bem(subject, subjects_dir):
     bem = mne.make_bem_solution(model)
     return bem
 
-def make_inverse_operator(raw, raw_fname, trans, src, bem, noise_cov):
+def make_inverse_operator(raw, raw_fname, trans, src, bem, noise_cov, n_jobs=None):
     # Make forward solution
-    fwd = mne.make_forward_solution(raw_fname, trans=trans, src=src, bem=bem, meg=True, eeg=False, mindist=5.0, n_jobs=None)
+    fwd = mne.make_forward_solution(raw_fname, trans=trans, src=src, bem=bem, meg=True, eeg=False, mindist=5.0, n_jobs=n_jobs)
     # Make inverse operator
     inverse_operator = mne.minimum_norm.make_inverse_operator(raw.info, fwd, noise_cov, loose=0.2, depth=0.8)
     return inverse_operator
 
-def compute_inverse_solution_rest(raw, inverse_operator, tmin=30, tmax=330):
+def compute_inverse_solution_rest(raw, inverse_operator, tmin=30, tmax=330, block_duration=None, sink=None):
     method = "dSPM"
     snr = 1.0           # Lower SNR for resting state than evoked responses
     lambda2 = 1./snr**2
     start, stop = raw.time_as_index([tmin, tmax])   # Range of time where we compute source activity
-    stc = mne.minimum_norm.apply_inverse_raw(raw, inverse_operator, lambda2, start=start, stop=stop, method=method, pick_ori=None)
-    return stc
+    if block_duration is None:
+        stc = mne.minimum_norm.apply_inverse_raw(raw, inverse_operator, lambda2, start=start, stop=stop, method=method, pick_ori=None)
+        return stc
+    # Streaming mode: apply the inverse in blocks of block_duration seconds and pass each block to
+    # sink(stc_block, offset), where offset is the first sample of the block relative to start.
+    # Peak memory then depends on the block size rather than the length of the recording.
+    # Prepare the inverse operator once instead of once per block
+    inverse_operator = mne.minimum_norm.prepare_inverse_operator(inverse_operator, nave=1, lambda2=lambda2, method=method)
+    block_size = int(round(block_duration * raw.info['sfreq']))
+    for block_start in range(start, stop, block_size):
+        block_stop = min(block_start + block_size, stop)
+        stc = mne.minimum_norm.apply_inverse_raw(raw, inverse_operator, lambda2, start=block_start, stop=block_stop, method=method, pick_ori=None, prepared=True)
+        sink(stc, block_start - start)
 
-def parcellate_source_data(src, stc, subject, fs_dir, output_dir, Vol, mode='mean_flip'):
+def array_sink(out):
+    # Sink writing each block into a preallocated (n_sources, n_times) array
+    # Pass a np.lib.format.open_memmap array to keep the full source reconstruction on disk
+    def sink(stc, offset):
+        out[:, offset:offset + stc.data.shape[1]] = stc.data
+    return sink
+
+def parcellation_sink(out, index):
+    # Sink reducing each block to parcel time series in a preallocated (n_labels, n_times) array, with
+    # one sparse product by the matrix of a parcellation index (see make_parcellation_index)
+    def sink(stc, offset):
+        out[:, offset:offset + stc.data.shape[1]] = index['matrix'] @ stc.data
+    return sink
+
+# Surface parcellations extracted for every subject (output name: FreeSurfer annotation)
+# All of them are reduced in one sparse product, so adding e.g. 'Schaefer400':
+# 'Schaefer2018_400Parcels_17Networks_order' or 'Destrieux': 'aparc.a2009s' costs little extra
+PARCELLATIONS = {'aparc': 'aparc',     # FreeSurfer default
+                 'Schaefer': 'Schaefer2018_200Parcels_17Networks_order'}
+
+def make_parcellation_index(src, vertices, subject, fs_dir, cache_dir, parcellations=PARCELLATIONS, mode='mean_flip'):
+    # Stack the label reductions of all parcellations (including mean_flip sign flips) into one sparse
+    # (n_labels, n_sources) matrix. It only depends on the subject's anatomy and the source vertices,
+    # so it is cached and reused by every later run for the subject
+    annot_fnames = [os.path.join(fs_dir, subject, 'label', hemi + '.' + parc + '.annot')
+                    for parc in parcellations.values() for hemi in ('lh', 'rh')]
+    key = stage_cache.stage_key('parc_index', inputs=annot_fnames,
+                                params=dict(subject=subject, parcellations=parcellations, mode=mode,
+                                            src_vertices=[s['vertno'].tolist() for s in src],
+                                            vertices=[vert.tolist() for vert in vertices]))
+    def compute_index():
+        matrices = []
+        parc_labels = dict()
+        for name, parc in parcellations.items():
+            labels = mne.read_labels_from_annot(subject, parc=parc, subjects_dir=fs_dir)
+            matrices.append(scipy.sparse.csr_matrix(make_label_reduction(labels, src, vertices, subject, mode=mode)))
+            parc_labels[name] = [str(lab.name) for lab in labels]
+        return dict(matrix=scipy.sparse.vstack(matrices, format='csr'), labels=parc_labels)
+    return stage_cache.run_stage(cache_dir, 'parc_index', key, 'parc_index', compute_index)
+
+def split_parcellations(index, parc_data):
+    # Split rows of data reduced with a parcellation index back into one array per parcellation
+    parc_ts = dict()
+    row = 0
+    for name, names in index['labels'].items():
+        parc_ts[name] = parc_data[row:row + len(names)]
+        row += len(names)
+    return parc_ts
+
+def write_parcellation_labels(index, output_dir):
+    # Write the label names of each parcellation next to the time series
+    for name, names in index['labels'].items():
+        with open(os.path.join(output_dir, name + '_labels.txt'),'w') as outfile:
+            outfile.write('\n'.join(names))
+
+def save_parcellations(index, parc_data, output_dir, store=None, sfreq=None, tmin=0., path='parcels', provenance=None):
+    # Save the parcel time series of each parcellation as parc_ts_beamformer_<name>.npy with the label
+    # names in <name>_labels.txt, or to path in the HDF5 output store file store (see output_store.py)
+    parc_ts = split_parcellations(index, parc_data)
+    if store is not None:
+        output_store.write_parcellations(store, parc_ts, index['labels'], sfreq, tmin, path=path, provenance=provenance)
+        return
+    write_parcellation_labels(index, output_dir)
+    for name, data in parc_ts.items():
+        np.save(os.path.join(output_dir, 'parc_ts_beamformer_' + name), data)
+
+def make_volume_parcellation_index(src, vertices, seg_fname, cache_dir):
+    # Sparse (n_regions, n_sources) matrix averaging the volume sources inside each region of a
+    # FreeSurfer segmentation (e.g. aparc+aseg.mgz), same format as make_parcellation_index
+    # Each source takes the label of the segmentation voxel nearest to it, the segmentation is
+    # only read when the index is not cached yet
+    key = stage_cache.stage_key('vol_parc_index', inputs=[seg_fname],
+                                params=dict(src_shape=list(src[0]['shape']), vertices=[vert.tolist() for vert in vertices]))
+    def compute_index():
+        import nibabel as nib   # Needed to read FreeSurfer volumes
+        seg = nib.load(seg_fname)
+        seg_data = np.asarray(seg.dataobj)
+        # Source positions are in FreeSurfer surface RAS (m), segmentation voxels are indexed with the tkr RAS (mm) transform
+        ras_vox_t = np.linalg.inv(seg.header.get_vox2ras_tkr())
+        vox = np.round(mne.transforms.apply_trans(ras_vox_t, src[0]['rr'][vertices[0]] * 1000.)).astype(int)
+        inside = np.all((vox >= 0) & (vox < seg_data.shape[:3]), axis=1)
+        seg_ids = np.zeros(len(vox), dtype=int)
+        seg_ids[inside] = seg_data[tuple(vox[inside].T)]
+        labelled = np.flatnonzero(seg_ids)    # 0 is 'Unknown'
+        label_ids, rows = np.unique(seg_ids[labelled], return_inverse=True)
+        counts = np.bincount(rows)
+        matrix = scipy.sparse.csr_matrix((1. / counts[rows], (rows, labelled)), shape=(len(label_ids), len(seg_ids)))
+        lut = {label_id: name for name, label_id in mne.read_freesurfer_lut()[0].items()}
+        names = [lut.get(label_id, str(label_id)) for label_id in label_ids]
+        return dict(matrix=matrix, labels={os.path.basename(seg_fname).split('.mgz')[0]: names})
+    return stage_cache.run_stage(cache_dir, 'vol_parc_index', key, 'parc_index', compute_index)
+
+def parcellate_source_data(src, stc, subject, fs_dir, output_dir, Vol, mode='mean_flip', store=None, provenance=None):
+    if Vol:
+        # Extract timeseries for aparc+aseg parcellated brain regions with one sparse product
+        # All volume sources share the same normal, so mean_flip reduces to mean here
+        if mode not in ('mean', 'mean_flip'):
+            raise ValueError("Mode '" + mode + "' is not supported for volume source spaces")
+        index = make_volume_parcellation_index(src, stc.vertices, os.path.join(fs_dir, subject, 'mri', 'aparc+aseg.mgz'), os.path.join(output_dir, 'cache'))
+    else:
+        # Aparc (FreeSurfer default) and Schaefer, extracted together in one sparse product
+        index = make_parcellation_index(src, stc.vertices, subject, fs_dir, os.path.join(output_dir, 'cache'), mode=mode)
+    save_parcellations(index, index['matrix'] @ stc.data, output_dir, store, 1. / stc.tstep, stc.tmin, provenance=provenance)
+
+def make_label_reduction(labels, src, vertices, subject, mode='mean_flip', block_size=1024):
+    # Label extraction as a (n_labels, n_sources) matrix, only possible for modes that are linear
+    # Built by passing identity source time courses through extract_label_time_course (a block of
+    # columns at a time), so vertex selection and sign flips match it exactly
+    if mode not in ('mean', 'mean_flip'):
+        raise ValueError("Mode '" + mode + "' is not linear and cannot be folded into a matrix")
+    n_sources = sum(len(vert) for vert in vertices)
+    reduction = np.zeros((len(labels), n_sources))
+    for block_start in range(0, n_sources, block_size):
+        n_block = min(block_size, n_sources - block_start)
+        identity = np.zeros((n_sources, n_block))
+        identity[block_start + np.arange(n_block), np.arange(n_block)] = 1.
+        stc = mne.SourceEstimate(identity, vertices, tmin=0, tstep=1, subject=subject)
+        reduction[:, block_start:block_start + n_block] = mne.extract_label_time_course(stc, labels, src, mode=mode)
+    return reduction
+
+def make_fused_lcmv(filters, reduction):
+    # Fold the whitening/projection and the label reduction into the LCMV weights, giving a
+    # (n_labels, n_channels) matrix that maps sensor data straight to parcel time series
+    # Only valid for a fixed orientation per source (e.g. pick_ori='max-power'), free orientations
+    # are combined non-linearly by apply_lcmv_raw
+    if filters['is_free_ori']:
+        raise ValueError('The fused projection needs one orientation per source, e.g. pick_ori="max-power"')
+    return reduction @ _sensor_weights(filters)
+
+def _sensor_weights(filters):
+    # Beamformer weights applied straight to the sensor data, same order of operations as apply_lcmv_raw
+    weights = filters['weights']
+    if filters['whitener'] is not None:
+        weights = weights @ filters['whitener']
+    elif filters.get('is_ssp', True):
+        weights = weights @ filters['proj']
+    return weights
+
+def apply_fused_lcmv_raw(raw, fused_weights, filters, start=None, stop=None, block_duration=10.):
+    # Apply the fused projection to raw data in blocks of block_duration seconds
+    picks = [raw.ch_names.index(ch) for ch in filters['ch_names']]
+    start = 0 if start is None else start
+    stop = raw.n_times if stop is None else min(stop, raw.n_times)
+    block_size = int(round(block_duration * raw.info['sfreq']))
+    parc_ts = np.empty((fused_weights.shape[0], stop - start))
+    for block_start in range(start, stop, block_size):
+        block_stop = min(block_start + block_size, stop)
+        data, _ = raw[picks, block_start:block_stop]
+        parc_ts[:, block_start - start:block_stop - start] = fused_weights @ data
+    return parc_ts
+
+def check_fused_lcmv(raw, filters, fused_weights, reduce, start=0, duration=10., rtol=1e-6):
+    # Compare the fused projection with apply_lcmv_raw followed by reduce(stc) on a short segment
+    stop = min(start + int(round(duration * raw.info['sfreq'])), raw.n_times)
+    stc = mne.beamformer.apply_lcmv_raw(raw, filters, start=start, stop=stop)
+    expected = reduce(stc)
+    fused = apply_fused_lcmv_raw(raw, fused_weights, filters, start=start, stop=stop)
+    max_err = np.abs(fused - expected).max() / np.abs(expected).max()
+    if max_err > rtol:
+        raise RuntimeError('Fused beamformer parcellation differs from apply_lcmv_raw + '
+                           'parcellation (relative error ' + str(max_err) + ')')
+
+def parcellate_fused_lcmv(raw, filters, src, subject, fs_dir, output_dir, Vol=False, start=None, stop=None, mode='mean_flip', check=True,
+                          store=None, provenance=None):
+    # Same outputs as parcellate_source_data, without building the vertex-level source estimate
+    # All parcellations are stacked into one fused (n_labels, n_channels) matrix
+    cache_dir = os.path.join(output_dir, 'cache')
+    if Vol:
+        index = make_volume_parcellation_index(src, filters['vertices'], os.path.join(fs_dir, subject, 'mri', 'aparc+aseg.mgz'), cache_dir)
+        # The volume index is already the reference reduction, this checks the folded weights
+        reduce = lambda stc: index['matrix'] @ stc.data
+    else:
+        index = make_parcellation_index(src, filters['vertices'], subject, fs_dir, cache_dir, mode=mode)
+        # Check against MNE's own label extraction
+        reduce = lambda stc: np.concatenate([mne.extract_label_time_course(stc, mne.read_labels_from_annot(subject, parc=PARCELLATIONS[name], subjects_dir=fs_dir), src, mode=mode)
+                                             for name in index['labels']])
+    fused_weights = make_fused_lcmv(filters, index['matrix'])
+    if check:
+        check_fused_lcmv(raw, filters, fused_weights, reduce, start=start or 0)
+    parc_data = apply_fused_lcmv_raw(raw, fused_weights, filters, start=start, stop=stop)
+    save_parcellations(index, parc_data, output_dir, store, raw.info['sfreq'], raw.times[start or 0], provenance=provenance)
+
+# make_lcmv settings that can vary within a sweep at little cost, see make_lcmv_sweep
+SWEEP_PARAMS = ('reg', 'weight_norm', 'pick_ori')
+
+def lcmv_grid(**params):
+    # All combinations of lists of make_lcmv settings, e.g.
+    #     lcmv_grid(reg=[0.01, 0.05, 0.1], weight_norm=['unit-noise-gain', 'nai'], pick_ori=['max-power'])
+    return [dict(zip(params, values)) for values in itertools.product(*params.values())]
+
+def lcmv_config_name(config):
+    # Directory name for the outputs of a beamformer setting, e.g. pick_ori-max-power_reg-0.05_weight_norm-nai
+    return '_'.join(key + '-' + str(value) for key, value in sorted(config.items()))
+
+def make_lcmv_sweep(info, fwd, data_cov, configs, check=True, rtol=1e-3):
+    # Beamformers for a list of make_lcmv settings (dicts of keyword arguments), computed together
+    # Settings that only differ in reg, weight_norm and pick_ori share the whitener, the whitened
+    # leadfield and the eigendecomposition of the whitened data covariance, so only the small
+    # per-source systems (3x3 or 1x1) are solved for each of them. The first setting of each group
+    # is also made by make_lcmv, which gives the whitener and checks the batched weights
+    # (max-power orientations of sources with a weak orientation are ill-conditioned, rounding
+    # differences change their weights by up to ~1e-4)
+    filters = [None] * len(configs)
+    groups = dict()
+    for k, config in enumerate(configs):
+        if config.get('depth') is not None or config.get('inversion', 'matrix') != 'matrix' or config.get('label') is not None:
+            raise ValueError('Beamformer sweeps only support depth=None, inversion="matrix" and no label')
+        if config.get('weight_norm', 'unit-noise-gain-invariant') not in (None, 'unit-noise-gain', 'unit-noise-gain-invariant', 'nai'):
+            raise ValueError("Weight normalization '" + str(config['weight_norm']) + "' is not supported in beamformer sweeps")
+        if config.get('pick_ori') == 'vector':
+            raise ValueError('Vector beamformers are not supported in beamformer sweeps')
+        shared = {key: value for key, value in config.items() if key not in SWEEP_PARAMS}
+        groups.setdefault(stage_cache.fingerprint(shared), []).append(k)
+    for group in groups.values():
+        reference = mne.beamformer.make_lcmv(info, fwd, data_cov, **configs[group[0]])
+        terms = _lcmv_sweep_terms(fwd, data_cov, reference, configs[group[0]].get('reduce_rank', False))
+        for k in group:
+            weights, max_power_ori = _lcmv_sweep_weights(terms, configs[k].get('reg', 0.05), configs[k].get('weight_norm', 'unit-noise-gain-invariant'),
+                                                         configs[k].get('pick_ori'), configs[k].get('reduce_rank', False))
+            filters[k] = mne.beamformer.Beamformer(reference, weights=weights, max_power_ori=max_power_ori,
+                                                   weight_norm=configs[k].get('weight_norm', 'unit-noise-gain-invariant'), pick_ori=configs[k].get('pick_ori'),
+                                                   is_free_ori=terms['n_orient'] == 3 and configs[k].get('pick_ori') is None)
+        if check:
+            max_err = np.abs(filters[group[0]]['weights'] - reference['weights']).max() / np.abs(reference['weights']).max()
+            if max_err > rtol:
+                raise RuntimeError('Batched beamformer weights differ from make_lcmv (relative error ' + str(max_err) + ')')
+    return filters
+
+def _lcmv_sweep_terms(fwd, data_cov, reference, reduce_rank):
+    # Whitened leadfield projected on the leading eigenvectors of the whitened data covariance,
+    # computed the same way as make_lcmv (the whitener of the reference beamformer includes the projectors)
+    ch_names = reference['ch_names']
+    fwd = mne.pick_channels_forward(fwd, ch_names, ordered=True, verbose=False)
+    n_orient = 1 if mne.forward.is_fixed_orient(fwd) else 3
+    gain = reference['whitener'] @ fwd['sol']['data']
+    n_sources = gain.shape[1] // n_orient
+    gain = gain.T.reshape(n_sources, n_orient, len(ch_names)).transpose(0, 2, 1)
+    if reduce_rank:
+        # Drop the weakest orientation of each source
+        u, s, vh = np.linalg.svd(gain, full_matrices=False)
+        gain = u[:, :, :-1] @ (s[:, :-1, np.newaxis] * vh[:, :-1, :])
+    cov = mne.pick_channels_cov(data_cov, include=ch_names, ordered=True, verbose=False)['data']
+    cov = reference['whitener'] @ cov @ reference['whitener'].T
+    cov = (cov + cov.T) / 2.
+    eigvals, eigvecs = np.linalg.eigh(cov)
+    eigvals, eigvecs = eigvals[::-1], eigvecs[:, ::-1]    # Largest first
+    rank = reference['rank']
+    # Max-power orientations get the sign of the local z axis (the surface normal with surface orientation)
+    nn = np.tile([0., 0., 1.], (n_sources, 1))
+    return dict(gain=eigvecs[:, :rank].T @ gain, eigvals=eigvals, eigvecs=eigvecs[:, :rank],
+                rank=rank, n_orient=n_orient, surf_ori=fwd['surf_ori'], nn=nn, by_reg=dict())
+
+def _lcmv_sweep_weights(terms, reg, weight_norm, pick_ori, reduce_rank):
+    # Beamformer weights for one setting from the shared terms (as mne.beamformer.make_lcmv)
+    # The regularized inverse covariance is diagonal in the eigenvector basis
+    eigvals, rank = terms['eigvals'], terms['rank']
+    loading = reg * np.mean(np.abs(eigvals))
+    inv_eigvals = 1. / (eigvals[:rank] + loading)
+    gain = terms['gain']
+    # The products of the leadfield of all orientations only depend on reg, so they are shared
+    # by the settings with the same reg
+    if reg not in terms['by_reg']:
+        numer = gain.transpose(0, 2, 1) * inv_eigvals
+        terms['by_reg'][reg] = numer, numer @ gain, numer @ numer.transpose(0, 2, 1)
+    all_numer, all_denom, all_power = terms['by_reg'][reg]
+    max_power_ori = None
+    if pick_ori == 'max-power':
+        if terms['n_orient'] != 3:
+            raise ValueError('Max-power orientation needs a forward solution with free orientation')
+        if weight_norm is None:
+            ori_pick = _sym_pow(all_denom, -1, reduce_rank)
+        else:
+            # Power, Sekihara & Nagarajan 2008 eq. 4.47
+            ori_pick = _sym_pow(all_power, -1, reduce_rank) @ all_denom
+        eig_vals, eig_vecs = np.linalg.eig(ori_pick)
+        max_power_ori = np.real(eig_vecs[np.arange(len(eig_vecs)), :, np.argmax(np.abs(eig_vals), axis=1)])
+        signs = np.sign(np.sum(max_power_ori * terms['nn'], axis=1, keepdims=True))
+        signs[signs == 0] = 1.
+        max_power_ori *= signs
+        gain = gain @ max_power_ori[:, :, np.newaxis]
+    elif pick_ori == 'normal':
+        if terms['n_orient'] != 3 or not terms['surf_ori']:
+            raise ValueError('Normal orientation needs a forward solution with free orientation in surface coordinates')
+        gain = gain[:, :, 2:3]
+    if pick_ori is None:
+        numer, denom, power = all_numer, all_denom, all_power
+    else:
+        numer = gain.transpose(0, 2, 1) * inv_eigvals
+        denom = numer @ gain
+        power = np.sum(numer**2, axis=2, keepdims=True)
+    if denom.shape[1] == 1:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            denom_inv = 1. / denom
+        denom_inv[~np.isfinite(denom_inv)] = 1.
+    else:
+        denom_inv = _sym_pow(denom, -1, reduce_rank)
+    weights = denom_inv @ numer
+    if weight_norm == 'unit-noise-gain-invariant':
+        # Rotation invariant version, whitens the orientations of each source together
+        weights = _sym_pow(power, -0.5) @ numer
+    elif weight_norm is not None:
+        # Unit noise gain: the eigenvectors are orthonormal, so the norm is the same in this basis
+        noise_norm = np.sqrt(np.sum(weights**2, axis=2, keepdims=True))
+        noise_norm[noise_norm == 0] = np.inf
+        weights /= noise_norm
+        if weight_norm == 'nai':
+            weights /= np.sqrt(max(terms['eigvals'][rank - 1], loading))
+    weights = weights.reshape(-1, rank) @ terms['eigvecs'].T
+    return weights, max_power_ori
+
+def _sym_pow(x, power, reduce_rank=False):
+    # Inverse (power -1) or inverse square root (power -0.5) of a stack of symmetric matrices,
+    # ignoring null eigenvalues and optionally the smallest one
+    eigvals, eigvecs = np.linalg.eigh(x)
+    eigvals[eigvals <= eigvals[:, -1:] * 1e-7] = np.inf
+    if reduce_rank:
+        eigvals[:, 0] = np.inf
+    return (eigvecs * eigvals[:, np.newaxis, :]**power) @ eigvecs.transpose(0, 2, 1)
+
+def apply_lcmv_sweep_raw(raw, filters, reduction, start=None, stop=None, block_duration=10.):
+    # Reduced (e.g. parcel) time series of every beamformer of a sweep, in one pass over the data
+    # Fixed orientation beamformers are folded into the reduction and stacked into one matrix, free
+    # orientation ones are applied a block at a time and combined across orientations as apply_lcmv_raw
+    ch_names = filters[0]['ch_names']
+    if any(filt['ch_names'] != ch_names for filt in filters):
+        raise ValueError('All the beamformers of a sweep must use the same channels')
+    picks = [raw.ch_names.index(ch) for ch in ch_names]
+    start = 0 if start is None else start
+    stop = raw.n_times if stop is None else min(stop, raw.n_times)
+    fixed = [k for k, filt in enumerate(filters) if not filt['is_free_ori']]
+    free = [k for k, filt in enumerate(filters) if filt['is_free_ori']]
+    fused = np.concatenate([make_fused_lcmv(filters[k], reduction) for k in fixed]) if fixed else None
+    free_weights = [_sensor_weights(filters[k]) for k in free]
+    n_labels = reduction.shape[0]
+    parc_ts = [np.empty((n_labels, stop - start)) for filt in filters]
+    block_size = int(round(block_duration * raw.info['sfreq']))
+    for block_start in range(start, stop, block_size):
+        block_stop = min(block_start + block_size, stop)
+        data, _ = raw[picks, block_start:block_stop]
+        block = slice(block_start - start, block_stop - start)
+        if fixed:
+            fused_data = fused @ data
+            for row, k in enumerate(fixed):
+                parc_ts[k][:, block] = fused_data[row * n_labels:(row + 1) * n_labels]
+        for weights, k in zip(free_weights, free):
+            source_data = (weights @ data).reshape(-1, 3, data.shape[1])
+            np.square(source_data, out=source_data)
+            parc_ts[k][:, block] = reduction @ np.sqrt(np.sum(source_data, axis=1))
+    return parc_ts
+
+def parcellate_lcmv_sweep(raw, filters, configs, src, subject, fs_dir, output_dir, Vol=False, start=None, stop=None, mode='mean_flip',
+                          store=None, provenance=None):
+    # Parcel time series of each beamformer of a sweep, saved as parcellate_source_data does to
+    # output_dir/lcmv_sweep/<settings>/ with the settings in settings.json
+    # (or to lcmv_sweep/<settings>/parcels in the output store, with the settings in the provenance)
+    cache_dir = os.path.join(output_dir, 'cache')
     if Vol:
-        # Extract timeseries for aparc parcellated brain regions
-        labels_aparc_aseg = fs_dir+subject+'/mri/aparc+aseg.mgz'
-        with open(os.path.join(output_dir, 'aparc+aseg_labels.txt'),'w') as outfile:
-            outfile.write('\n'.join(str(lab.name) for lab in labels_aparc_aseg))
-        parc_ts_aparc_aseg = mne.extract_label_time_course(stc, labels_aparc_aseg, src, mode=mode)
-        np.save(output_dir + 'parc_ts_beamformer_aparc', parc_ts_aparc_aseg)
+        index = make_volume_parcellation_index(src, filters[0]['vertices'], os.path.join(fs_dir, subject, 'mri', 'aparc+aseg.mgz'), cache_dir)
     else:
-        # Aparc (FreeSurfer default)
-        labels_aparc = mne.read_labels_from_annot(subject, parc='aparc', subjects_dir=fs_dir)
-        with open(os.path.join(output_dir, 'aparc_labels.txt'),'w') as outfile:
-            outfile.write('\n'.join(str(lab.name) for lab in labels_aparc))
-        # Schaefer
-        labels_schaefer = mne.read_labels_from_annot(subject, parc='Schaefer2018_200Parcels_17Networks_order', subjects_dir=fs_dir)
-        with open(os.path.join(output_dir, 'Schaefer_labels.txt'),'w') as outfile:
-            outfile.write('\n'.join(str(lab.name) for lab in labels_schaefer))
-        # Extract timeseries for parcellations
-        # Aparc
-        aparc_ts = mne.extract_label_time_course(stc, labels_aparc, src, mode=mode)
-        np.save(os.path.join(output_dir, 'parc_ts_beamformer_aparc'), aparc_ts)
-        # Schaefer
-        schaefer_ts = mne.extract_label_time_course(stc, labels_schaefer, src, mode=mode)
-        np.save(os.path.join(output_dir, 'parc_ts_beamformer_Schaefer'), schaefer_ts)
+        index = make_parcellation_index(src, filters[0]['vertices'], subject, fs_dir, cache_dir, mode=mode)
+    parc_data = apply_lcmv_sweep_raw(raw, filters, index['matrix'], start=start, stop=stop)
+    for config, config_data in zip(configs, parc_data):
+        if store is not None:
+            save_parcellations(index, config_data, output_dir, store, raw.info['sfreq'], raw.times[start or 0],
+                               path='lcmv_sweep/' + lcmv_config_name(config) + '/parcels', provenance=dict(provenance or {}, lcmv=config))
+            continue
+        config_dir = os.path.join(output_dir, 'lcmv_sweep', lcmv_config_name(config))
+        os.makedirs(config_dir, exist_ok=True)
+        with open(os.path.join(config_dir, 'settings.json'), 'w') as outfile:
+            json.dump(config, outfile, indent=1, default=str)
+        save_parcellations(index, config_data, config_dir)
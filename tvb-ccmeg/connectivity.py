@@ -0,0 +1,192 @@
+#!/bin/env python
+#
+# Module name: connectivity.py
+#
+# Description: Functions and script to compute band-limited functional connectivity (amplitude
+#              envelope correlation, phase locking value, coherence) from the parcel time series
+#              written by the beamformer pipeline (parc_ts_beamformer_*.npy)
+#
+# License: Apache 2.0
+
+import numpy as np      # Need for array operations
+import scipy.fft
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+import scheduler        # Module with functions to share the cores between parallel jobs and BLAS threads
+import run_batch        # Subject lists and sharing the cores between worker processes
+import output_store     # Module with functions to write the time series to one HDF5 file per subject
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Canonical frequency bands (Hz), gamma stops below the 50 Hz power line
+BANDS = {'delta': (1., 4.), 'theta': (4., 8.), 'alpha': (8., 13.), 'beta': (13., 30.), 'gamma': (30., 45.)}
+METRICS = ('aec', 'plv', 'coh')
+
+def band_masks(n_fft, sfreq, bands=BANDS, transition=1.):
+    # (n_bands, n_fft) frequency responses of the band-pass filters that also give the analytic
+    # signal: zero for negative frequencies, 2 in the pass band, raised cosine edges transition Hz wide
+    freqs = scipy.fft.fftfreq(n_fft, 1. / sfreq)
+    masks = np.zeros((len(bands), n_fft))
+    for k, (l_freq, h_freq) in enumerate(bands.values()):
+        rise = np.clip((freqs - l_freq + transition / 2.) / transition, 0., 1.)
+        fall = np.clip((h_freq + transition / 2. - freqs) / transition, 0., 1.)
+        masks[k] = 2. * np.sin(np.pi / 2. * rise)**2 * np.sin(np.pi / 2. * fall)**2
+    masks[:, freqs <= 0] = 0.
+    return masks
+
+def band_analytic_signals(data, sfreq, bands=BANDS, transition=1.):
+    # Analytic signals of all bands of all the time series in data (n_signals, n_times) from one
+    # FFT of the data and one batched inverse FFT: (n_bands, n_signals, n_times) complex array
+    n_times = data.shape[-1]
+    n_fft = scipy.fft.next_fast_len(n_times)
+    spectrum = scipy.fft.fft(data, n_fft, axis=-1)
+    masks = band_masks(n_fft, sfreq, bands, transition)
+    return scipy.fft.ifft(spectrum[np.newaxis] * masks[:, np.newaxis], axis=-1)[..., :n_times]
+
+def _window_statistics(analytic, metrics):
+    # Mergeable statistics of one window for each metric, all bands at once
+    stats = dict(n=analytic.shape[-1])
+    if 'aec' in metrics:
+        # Mean and scatter matrix of the amplitude envelopes
+        envelope = np.abs(analytic)
+        stats['mean'] = envelope.mean(axis=-1)
+        envelope -= stats['mean'][..., np.newaxis]
+        stats['scatter'] = envelope @ envelope.swapaxes(-1, -2)
+    if 'coh' in metrics:
+        # Cross-spectrum of the analytic signals
+        stats['cross'] = analytic @ analytic.conj().swapaxes(-1, -2)
+    if 'plv' in metrics:
+        phase = analytic / np.maximum(np.abs(analytic), np.finfo(float).tiny)
+        stats['phase'] = phase @ phase.conj().swapaxes(-1, -2)
+    return stats
+
+def _merge_statistics(total, stats):
+    # Sums add up, means and scatter matrices are merged with Chan et al.'s pairwise update
+    if total is None:
+        return stats
+    n = total['n'] + stats['n']
+    if 'mean' in stats:
+        delta = stats['mean'] - total['mean']
+        total['scatter'] = total['scatter'] + stats['scatter'] + delta[..., :, np.newaxis] * delta[..., np.newaxis, :] * (total['n'] * stats['n'] / n)
+        total['mean'] = total['mean'] + delta * (stats['n'] / n)
+    for key in ('cross', 'phase'):
+        if key in stats:
+            total[key] = total[key] + stats[key]
+    total['n'] = n
+    return total
+
+def compute_connectivity(data, sfreq, bands=BANDS, metrics=METRICS, window=None, margin=2., transition=1.):
+    # Connectivity matrices (n_bands, n_signals, n_signals) between the rows of data (n_signals, n_times),
+    # returned as a dict metric -> matrices:
+    #   'aec' - Pearson correlation of the amplitude envelopes
+    #   'plv' - phase locking value
+    #   'coh' - magnitude of the coherence of the band-limited analytic signals
+    # With window (s) the data is processed window by window, read with margin s of extra data on
+    # both sides for the filters, and the statistics of the windows are merged, so only one window
+    # needs to be in memory (data can be a memory-mapped array, e.g. np.load(fname, mmap_mode='r'))
+    # The ends of the recording are padded by reflection
+    for metric in metrics:
+        if metric not in METRICS:
+            raise ValueError("Unknown connectivity metric '" + metric + "'")
+    n_times = data.shape[-1]
+    window = n_times if window is None else int(round(window * sfreq))
+    pad = int(round(margin * sfreq))
+    total = None
+    for start in range(0, n_times, window):
+        stop = min(start + window, n_times)
+        read_start, read_stop = max(start - pad, 0), min(stop + pad, n_times)
+        chunk = np.asarray(data[:, read_start:read_stop], dtype=float)
+        # Reflect at the ends of the recording so every window sees margin s of data on both sides
+        pad_before, pad_after = min(pad - (start - read_start), chunk.shape[1] - 1), min(pad - (read_stop - stop), chunk.shape[1] - 1)
+        chunk = np.pad(chunk, ((0, 0), (pad_before, pad_after)), mode='reflect')
+        first = start - read_start + pad_before
+        analytic = band_analytic_signals(chunk, sfreq, bands, transition)[..., first:first + stop - start]
+        total = _merge_statistics(total, _window_statistics(analytic, metrics))
+        del analytic
+    conn = dict()
+    if 'aec' in metrics:
+        std = np.sqrt(np.diagonal(total['scatter'], axis1=-2, axis2=-1))
+        conn['aec'] = total['scatter'] / (std[..., :, np.newaxis] * std[..., np.newaxis, :])
+    if 'plv' in metrics:
+        conn['plv'] = np.abs(total['phase']) / total['n']
+    if 'coh' in metrics:
+        power = np.real(np.diagonal(total['cross'], axis1=-2, axis2=-1))
+        conn['coh'] = np.abs(total['cross']) / np.sqrt(power[..., :, np.newaxis] * power[..., np.newaxis, :])
+    return conn
+
+def find_parcel_time_series(subject_dir):
+    # Parcel time series of a subject, including those of beamformer sweeps (lcmv_sweep/<settings>/)
+    fnames = []
+    for dname, _, files in os.walk(subject_dir):
+        fnames += [os.path.join(dname, fname) for fname in files if fname.startswith('parc_ts_beamformer_') and fname.endswith('.npy')]
+    return sorted(fnames)
+
+def subject_connectivity(subject_dir, sfreq, bands=BANDS, metrics=METRICS, window=60., margin=2.):
+    # Connectivity of every parcel time series of a subject, saved next to it as
+    # connectivity_<parcellation>.npz with the band names and edges
+    # Parcel time series in an HDF5 output store (outputs.h5) are read window by window with the sampling
+    # frequency stored with them, their connectivity goes to the same relative directory as the .npy outputs
+    fnames = find_parcel_time_series(subject_dir)
+    inputs = [(np.load(fname, mmap_mode='r'), sfreq, fname) for fname in fnames]
+    store_fname = output_store.store_fname(subject_dir)
+    store = output_store.open_store(store_fname) if os.path.isfile(store_fname) else None
+    try:
+        if store is not None:
+            for path in output_store.list_arrays(store):
+                if os.path.basename(os.path.dirname(path)) == 'parcels':
+                    fname = os.path.join(subject_dir, os.path.dirname(os.path.dirname(path)), 'parc_ts_beamformer_' + os.path.basename(path) + '.npy')
+                    inputs.append((store[path], float(store[path].attrs['sfreq']), fname))
+        for data, data_sfreq, fname in inputs:
+            conn = compute_connectivity(data, data_sfreq, bands, metrics, window=window, margin=margin)
+            out_fname = os.path.join(os.path.dirname(fname), 'connectivity_' + os.path.basename(fname)[len('parc_ts_beamformer_'):-len('.npy')] + '.npz')
+            os.makedirs(os.path.dirname(out_fname), exist_ok=True)
+            np.savez(out_fname, bands=list(bands), band_edges=np.array(list(bands.values())), sfreq=data_sfreq, **conn)
+    finally:
+        if store is not None:
+            store.close()
+    return len(inputs)
+
+def _run_subject(subject_dir, sfreq, metrics, window, margin):
+    # Runs in a worker process, errors are returned so one bad subject doesn't stop the others
+    start = time.perf_counter()
+    try:
+        n_files = subject_connectivity(subject_dir, sfreq, metrics=metrics, window=window, margin=margin)
+        error = None if n_files else 'No parcel time series found'
+    except Exception:
+        error = traceback.format_exc()
+    return error, time.perf_counter() - start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute AEC, PLV and coherence matrices in the canonical bands '
+                                                 'for the parcel time series of a list of subjects.')
+    parser.add_argument('processed_dir', help='Processed MEG directory (one directory per subject)')
+    parser.add_argument('subject_list', help='Text file with one subject per line')
+    parser.add_argument('--n_workers', type=int, default=1, help='Subjects processed at once')
+    parser.add_argument('--sfreq', type=float, default=500., help='Sampling frequency of the parcel time series in .npy files (Hz)')
+    parser.add_argument('--window', type=float, default=60., help='Window length (s), 0 for the whole recording at once')
+    parser.add_argument('--margin', type=float, default=2., help='Extra data on both sides of each window for the filters (s)')
+    parser.add_argument('--metrics', nargs='+', default=list(METRICS), choices=METRICS)
+    args = parser.parse_args()
+
+    subjects = run_batch.read_subject_list(args.subject_list)
+    # Each worker gets an equal share of the cores as BLAS threads for its matrix products,
+    # set before the workers start so numpy picks them up when it is imported
+    n_workers, worker_cpu = run_batch.split_cores(scheduler.available_cpus(), args.n_workers)
+    for variable in run_batch.THREAD_VARIABLES:
+        os.environ[variable] = str(worker_cpu)
+    failed = []
+    with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(_run_subject, os.path.join(args.processed_dir, subject), args.sfreq, args.metrics,
+                                   args.window or None, args.margin): subject for subject in subjects}
+        for future in as_completed(futures):
+            error, run_time = future.result()
+            print(futures[future] + (' failed' if error else ' finished') + ' in ' + str(round(run_time)) + ' s\n' + (error or ''))
+            if error:
+                failed.append(futures[future])
+    print(str(len(subjects) - len(failed)) + ' of ' + str(len(subjects)) + ' subjects processed')
+    if failed:
+        print('Failed subjects:\n' + '\n'.join(failed))
+        sys.exit(1)
@@ -0,0 +1,224 @@
+#!/bin/env python
+#
+# Module name: output_store.py
+#
+# Description: Functions to write the sensor, source and parcel time series of a subject to one
+#              HDF5 file (chunked, compressed float32 arrays with their labels, sampling frequency
+#              and provenance), to read slices of them lazily, and script to build a cohort index
+#              linking the files of all the subjects
+#
+# License: Apache 2.0
+
+import mne
+import numpy as np      # Need for array operations
+import datetime
+import json
+import os
+import sys
+try:
+    import h5py         # Needed for the HDF5 output store
+except ImportError:
+    h5py = None
+
+# Layout of a subject's store (<processed_meg>/<subject>/outputs.h5):
+#   /sensor                     (n_channels, n_times) preprocessed sensor data, with ch_names, ch_types and bads
+#   /source                     (n_sources, n_times) source estimate
+#   /source_space/<hemi>        vertices of the source estimate, with their positions (rr) and normals (nn)
+#   /parcels/<parcellation>     (n_labels, n_times) parcel time series, with the label names
+#   /lcmv_sweep/<settings>/parcels/<parcellation>   the same for each beamformer of a sweep
+# Every time series has sfreq, tmin and the provenance (JSON) of the stage that wrote it as attributes
+STORE_NAME = 'outputs.h5'
+COHORT_NAME = 'cohort.h5'
+
+# Chunks of 16 rows x 4096 samples (256 kB of float32): reading one parcel or a short time window
+# only decompresses a few chunks
+CHUNK_ROWS = 16
+CHUNK_TIMES = 4096
+
+def _check_h5py():
+    if h5py is None:
+        raise RuntimeError('The HDF5 output store needs h5py')
+
+def store_fname(output_dir):
+    return os.path.join(output_dir, STORE_NAME)
+
+def provenance(**fields):
+    # Software versions and time, plus any fields given (e.g. pipeline parameters or stage keys)
+    return dict(fields, created=datetime.datetime.now().isoformat(timespec='seconds'),
+                mne=mne.__version__, numpy=np.__version__, h5py=h5py.__version__ if h5py else None,
+                python=sys.version.split()[0])
+
+def _create_array(store, path, shape, compression='gzip', **attrs):
+    # Empty float32 array, replacing any array written by an earlier run
+    # compression=None writes an uncompressed contiguous array that can be memory mapped (see memmap_array)
+    if path in store:
+        del store[path]
+    if compression is None:
+        dataset = store.create_dataset(path, shape, dtype=np.float32)
+    else:
+        chunks = (min(shape[0], CHUNK_ROWS), min(shape[1], CHUNK_TIMES))
+        dataset = store.create_dataset(path, shape, dtype=np.float32, chunks=chunks, compression=compression, shuffle=True)
+    for key, value in attrs.items():
+        if isinstance(value, dict):
+            value = json.dumps(value, default=str)
+        if value is not None:
+            dataset.attrs[key] = value
+    return dataset
+
+def write_array(fname, path, data, sfreq, tmin=0., labels=None, provenance=None, compression='gzip', **attrs):
+    # Write a (n_rows, n_times) array as float32 to path in the store fname (created if needed)
+    _check_h5py()
+    with h5py.File(fname, 'a') as store:
+        dataset = _create_array(store, path, data.shape, compression, sfreq=sfreq, tmin=tmin, labels=labels,
+                                provenance=provenance, **attrs)
+        for block_start in range(0, data.shape[1], CHUNK_TIMES):
+            dataset[:, block_start:block_start + CHUNK_TIMES] = data[:, block_start:block_start + CHUNK_TIMES]
+
+def write_raw(fname, raw, path='sensor', provenance=None, compression='gzip', block_duration=10.):
+    # Preprocessed sensor data (with the projectors applied), written in blocks of block_duration s
+    # so the whole recording is never converted at once
+    _check_h5py()
+    picks = mne.pick_types(raw.info, meg=True, eeg=True, eog=True, ecg=True, ref_meg=False, exclude=())
+    ch_names = [raw.ch_names[pick] for pick in picks]
+    block_size = int(round(block_duration * raw.info['sfreq']))
+    with h5py.File(fname, 'a') as store:
+        dataset = _create_array(store, path, (len(picks), raw.n_times), compression, sfreq=raw.info['sfreq'],
+                                tmin=raw.times[0], first_samp=raw.first_samp, labels=ch_names,
+                                ch_types=raw.get_channel_types(picks=picks), bads=list(raw.info['bads']),
+                                provenance=provenance)
+        for block_start in range(0, raw.n_times, block_size):
+            block_stop = min(block_start + block_size, raw.n_times)
+            dataset[:, block_start:block_stop] = raw.get_data(picks, block_start, block_stop)
+
+def write_stc(fname, stc, src=None, path='source', provenance=None, compression='gzip'):
+    # Source estimate, with its vertices (and their positions and normals when the source space is given)
+    _check_h5py()
+    write_array(fname, path, stc.data, 1. / stc.tstep, stc.tmin, provenance=provenance, compression=compression,
+                subject=stc.subject)
+    write_source_space(fname, stc.vertices, src, path=path + '_space')
+
+def write_source_space(fname, vertices, src=None, path='source_space'):
+    # Vertices used in each hemisphere (or volume) of the source space, with their positions and
+    # normals when the source space is given
+    _check_h5py()
+    hemis = ['lh', 'rh'] if len(vertices) == 2 else ['vol%d' % k for k in range(len(vertices))]
+    with h5py.File(fname, 'a') as store:
+        if path in store:
+            del store[path]
+        for k, (hemi, vert) in enumerate(zip(hemis, vertices)):
+            group = store.create_group(path + '/' + hemi)
+            group['vertices'] = vert
+            if src is not None:
+                group['rr'] = src[k]['rr'][vert].astype(np.float32)
+                group['nn'] = src[k]['nn'][vert].astype(np.float32)
+
+def write_parcellations(fname, parc_ts, labels, sfreq, tmin=0., path='parcels', provenance=None, compression='gzip'):
+    # Parcel time series of each parcellation (dicts of name -> (n_labels, n_times) array and label names)
+    for name, data in parc_ts.items():
+        write_array(fname, path + '/' + name, data, sfreq, tmin, labels=labels[name], provenance=provenance,
+                    compression=compression)
+
+def open_store(fname):
+    # Open a subject store (or the cohort index) for lazy reading: arrays are h5py datasets, read from
+    # disk only when sliced, e.g. open_store(fname)['parcels/aparc'][3, 1000:2000]
+    _check_h5py()
+    return h5py.File(fname, 'r')
+
+def _json_attr(value):
+    return json.loads(value) if isinstance(value, str) and value[:1] in '{[' else value
+
+def read_attrs(dataset):
+    # Attributes of an array as Python objects (label names as a list of str, provenance as a dict)
+    attrs = dict()
+    for key, value in dataset.attrs.items():
+        if isinstance(value, np.ndarray) and value.dtype.kind in 'OS':
+            value = [item.decode() if isinstance(item, bytes) else str(item) for item in value]
+        attrs[key] = _json_attr(value)
+    return attrs
+
+def read_array(fname, path, labels=None, tmin=None, tmax=None):
+    # Read the rows given by their label (or channel) names and the time range tmin-tmax (s, relative
+    # to the start of the array) of an array, without reading the rest of it
+    with open_store(fname) as store:
+        return _read_slice(store[path], labels, tmin, tmax)
+
+def _read_slice(dataset, labels, tmin, tmax):
+    attrs = read_attrs(dataset)
+    start = 0 if tmin is None else int(round(tmin * attrs['sfreq']))
+    stop = dataset.shape[1] if tmax is None else int(round(tmax * attrs['sfreq']))
+    if labels is None:
+        return dataset[:, start:stop], attrs
+    missing = [label for label in labels if label not in attrs['labels']]
+    if missing:
+        raise ValueError('Labels not found in ' + dataset.name + ': ' + ', '.join(missing))
+    # HDF5 selections need increasing rows, read them in that order and put them back in the order asked for
+    rows = np.array([attrs['labels'].index(label) for label in labels])
+    unique, inverse = np.unique(rows, return_inverse=True)
+    attrs['labels'] = list(labels)
+    return dataset[unique.tolist(), start:stop][inverse], attrs
+
+def memmap_array(fname, path):
+    # Memory map an array written with compression=None (stored contiguously), for random access
+    # without h5py in the reading process
+    with open_store(fname) as store:
+        dataset = store[path]
+        offset = dataset.id.get_offset()
+        if dataset.chunks is not None or offset is None:
+            raise ValueError(path + ' is chunked or compressed and cannot be memory mapped, use open_store or read_array')
+        return np.memmap(fname, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape)
+
+def list_arrays(store):
+    # Paths of the time series in a store, with their shape and attributes
+    arrays = dict()
+    def visit(path, obj):
+        if isinstance(obj, h5py.Dataset) and 'sfreq' in obj.attrs:
+            arrays[path] = dict(shape=list(obj.shape), sfreq=float(obj.attrs['sfreq']),
+                                n_labels=len(obj.attrs['labels']) if 'labels' in obj.attrs else None)
+    store.visititems(visit)
+    return arrays
+
+def write_cohort_index(processed_dir, subjects, fname=None):
+    # One file linking the store of each subject (/<subject> is an external link to the root of
+    # <subject>/outputs.h5, relative to processed_dir), plus a table of the arrays of each subject,
+    # so a cohort can be queried without opening every subject's file
+    _check_h5py()
+    fname = fname or os.path.join(processed_dir, COHORT_NAME)
+    index, missing = dict(), []
+    for subject in subjects:
+        subject_fname = store_fname(os.path.join(processed_dir, subject))
+        if not os.path.isfile(subject_fname):
+            missing.append(subject)
+            continue
+        with open_store(subject_fname) as store:
+            index[subject] = list_arrays(store)
+    with h5py.File(fname, 'w') as cohort:
+        for subject in index:
+            cohort[subject] = h5py.ExternalLink(os.path.relpath(store_fname(os.path.join(processed_dir, subject)),
+                                                                os.path.dirname(os.path.abspath(fname))), '/')
+        cohort.attrs['index'] = json.dumps(index)
+        cohort.attrs['provenance'] = json.dumps(provenance(subjects=len(subjects), missing=missing))
+    return index, missing
+
+def read_cohort_index(fname):
+    # subject -> {path: shape, sfreq and number of labels} of the arrays in each subject's store
+    with open_store(fname) as cohort:
+        return json.loads(cohort.attrs['index'])
+
+def read_cohort(fname, path, subjects=None, labels=None, tmin=None, tmax=None):
+    # The same slice (labels and time range) of one array from the store of each subject, only
+    # opening the stores of the subjects that have it. Returns a dict of subject -> (data, attrs)
+    index = read_cohort_index(fname)
+    subjects = [subject for subject in (subjects or index) if path in index.get(subject, {})]
+    # External links are followed relative to the directory of the index file
+    with open_store(fname) as cohort:
+        return {subject: _read_slice(cohort[subject + '/' + path], labels, tmin, tmax) for subject in subjects}
+
+if __name__ == '__main__':
+    if len(sys.argv) <= 2:
+        raise ValueError("A processed data directory and a subject list have not been provided. Usage:"
+                         "\n\tpython output_store.py <processed_meg_dir> <subject_list.txt>")
+    import run_batch    # Subject list reader
+    index, missing = write_cohort_index(sys.argv[1], run_batch.read_subject_list(sys.argv[2]))
+    print(str(len(index)) + ' subjects indexed in ' + os.path.join(sys.argv[1], COHORT_NAME))
+    if missing:
+        print('Subjects without an output store:\n' + '\n'.join(missing))
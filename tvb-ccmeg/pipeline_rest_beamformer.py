@@ -1,6 +1,6 @@
 #!/bin/env python
 #
-# Module name: beamformer_test.py
+# Module name: pipeline_rest_beamformer.py
 #
 # Description: Script to test pipeline for TVB Cam-CAN MEG
 #
@@ -11,23 +11,14 @@
 import mne              # Need MNE Python
 import preprocess       # Module with all the preprocessing functions
 import compute_source   # Module with functions to go from sensor space to source space
-import numpy as np      # Need for array operations
+import stage_cache      # Module with functions to cache intermediate results between runs
+import scheduler        # Module with functions to share the cores between parallel jobs and BLAS threads
+import profiling        # Module with functions to record the time and memory used by each stage
+import output_store     # Module with functions to write the time series to one HDF5 file per subject
 import os
 import sys
 # IF the MNE wheel on cedar is used, then sklearn, nibabel and python-picard also need to be imported
 
-# Check if a subject is passed
-
-if len(sys.argv) <= 1:
-    raise ValueError("A subject directory has not been provided. Usage:"
-                     "\n\tpython pipeline_rest_beamformer.py <subject_name>")
-else:
-    subject = sys.argv[1]
-
-# Set number of cores for parallel processing (must be done before running any linear algebra functions)
-num_cpu = '16'
-os.environ['OMP_NUM_THREADS'] = num_cpu
-
 # Get paths to files
 data_dir = os.path.abspath('./_Data')  # Parent directory
 
@@ -42,17 +33,9 @@ meg_dir = os.path.join(data_dir, 'meg')  # Directory containing MEG data
 rest_raw_dname = os.path.join(meg_dir, 'release005/BIDSsep/derivatives_rest/aa/AA_nomovecomp/aamod_meg_maxfilt_00001')
 er_dname = os.path.join(meg_dir, 'release004/BIDS_20190411/meg_emptyroom')
 trans_dname = os.path.join(meg_dir, 'camcan_coreg/trans')
-raw_fname = os.path.join(rest_raw_dname, subject, 'mf2pt2_' + subject + '_ses-rest_task-rest_meg.fif')
-er_fname = os.path.join(er_dname, subject, 'emptyroom/emptyroom_' + subject[4:] + '.fif')
-trans = os.path.join(trans_dname, subject + '-trans.fif')
 # FreeSurfer outputs should be in a directory called 'freesurfer' with same parent directory as the pipeline code
 fs_dir = os.path.join(data_dir,'mri/freesurfer')
 
-# We want to save output at various points in the pipeline
-output_dir = os.path.join(data_dir, 'processed_meg', subject)
-if not os.path.isdir(output_dir):
-	os.mkdir(output_dir)
-
 # Set ECG / EOG correction method (options are ICA and SSP, setting ICA to False uses SSP)
 
 ICA = False
@@ -61,88 +44,247 @@ ICA = False
 
 Vol = False
 
-# Read resting-state data
-raw = preprocess.read_data(raw_fname)
-raw.crop(tmin=30, tmax=390)
-raw.del_proj()                          # Don't want existing projectors, could add to preprocess.read_data() if we never want them
-if ICA:
-	raw.pick(['meg', 'eog', 'ecg'])
-else:
-	raw.pick(['grad', 'eog', 'ecg'])
-
-# Filter data to remove line noise, slow drifts, and frequencies too high to be of interest
-l_freq = 1.0    # High pass frequency in Hz
-h_freq = 90     # Low pass frequency in Hz
-raw = preprocess.filter_data(raw,l_freq=l_freq,h_freq=h_freq)
-
-# Remove heartbeat and eye movement artifacts
-if ICA:
-	pick_meg = mne.pick_types(raw.info, meg=True, eeg=False, stim=False, ref_meg=False)
-	raw, ica = preprocess.do_ICA(raw, picks=pick_meg, method = "picard")
-else:
-	raw = preprocess.add_ecg_projectors(raw)
-	raw = preprocess.add_eog_projectors(raw)
-
-# Downsample raw data to speed up computation
-new_sfreq = 500
-raw.resample(new_sfreq)
+# Parcellate with a fused beamformer + parcellation projection that never builds the vertex-level
+# source estimate (checked against the standard path on a short segment)
 
-# Save processed Raw data
+fused_parcellation = False
 
-raw.save(os.path.join(output_dir, 'sensor_processed_meg.fif'), overwrite=True)
+# Save the full vertex-level source estimate (stc_beamformer)
 
-# Compute data covariance from two minutes of raw recording
-if ICA:
-	raw.pick('grad')
+save_stc = True
 
-data_cov = mne.compute_raw_covariance(raw, tmin=30, tmax=150)
+# Output format: 'files' saves sensor_processed_meg.fif, src_beamformer-src.fif, stc_beamformer and the
+# parc_ts_beamformer_*.npy files with their *_labels.txt; 'hdf5' writes the sensor, source and parcel time
+# series as compressed float32 arrays with their labels, sampling frequency and provenance to one file,
+# outputs.h5 (see output_store.py)
 
-# Compute noise covariance from empty room recording
-er_raw = preprocess.read_data(er_fname)
-er_raw.del_proj()
-if ICA:
-	er_raw.pick(['meg'])	# I realize that this doesn' make sense but I need the mags for the ICA
-else:
-	er_raw.pick(['grad'])
+output_format = 'files'
 
-er_raw = preprocess.filter_data(er_raw,l_freq=l_freq,h_freq=h_freq)
-if ICA:
-	ica.apply(er_raw)
-else:
-	er_raw.add_proj(raw.info['projs'])
-	er_raw.apply_proj()
+# Sweep mode, to compare beamformer settings without rerunning the pipeline for each: a list of
+# make_lcmv settings (None for the single beamformer below). They are computed together from the same
+# covariance and forward solution, and the parcel time series of each are saved to lcmv_sweep/<settings>/
+# reg, weight_norm and pick_ori cost little to vary, other settings (e.g. rank) add a make_lcmv call each
 
-er_raw.resample(new_sfreq)
-if ICA:
-	er_raw.pick(['grad'])
+lcmv_sweep = None
+# lcmv_sweep = compute_source.lcmv_grid(reg=[0.01, 0.05, 0.1], weight_norm=['unit-noise-gain', 'nai'], pick_ori=['max-power'], rank=['info'])
+# lcmv_sweep += [dict(reg=0.05, pick_ori=None, weight_norm=None, rank=None)]     # Vasily's settings
 
-noise_cov = mne.compute_raw_covariance(er_raw)
-
-# Make boundary element model (BEM) surfaces if there isn't already a file
-if not os.path.isfile(fs_dir + '/' + subject + '/bem/watershed/' + subject + '-meg-bem.fif'):
-    mne.bem.make_watershed_bem(subject, subjects_dir=fs_dir, overwrite=True)
-
-# This section requires previously-computed BEM surfaces to be in the FreeSurfer directory
-# Set up forward solution
-bem = compute_source.make_bem(subject, fs_dir)
-
-if Vol:
-	src = mne.setup_volume_source_space(subject=subject, subjects_dir=fs_dir, bem=bem)
-else:
-	src = mne.setup_source_space(subject, subjects_dir=fs_dir) 
-
-fwd = mne.make_forward_solution(raw.info, trans=trans, src=src, bem=bem, meg=True, eeg=False, mindist=5.0, n_jobs=None)
-src.save(os.path.join(output_dir, 'src_beamformer-src.fif'), overwrite=True)
-
-# Compute the spatial filter
-filts = mne.beamformer.make_lcmv(raw.info, fwd, data_cov, reg=0.05, noise_cov=None, pick_ori='max-power', weight_norm='unit-noise-gain', rank='info')
-
-# pick_ori=None, weight_norm=None, depth=None, rank=None) #Vasily's settings
+# Filter data to remove line noise, slow drifts, and frequencies too high to be of interest
+l_freq = 1.0    # High pass frequency in Hz
+h_freq = 90     # Low pass frequency in Hz
 
-# Apply beamformer
-start, stop = raw.time_as_index([30, 390])
-stc = mne.beamformer.apply_lcmv_raw(raw, filts, start=start, stop=stop)
-stc.save(os.path.join(output_dir, 'stc_beamformer'), overwrite=True)
+# Downsample raw data to speed up computation. The subject recording is downsampled after artifact
+# removal, so heartbeats, blinks and the ICA are estimated at the original rate. The empty room recording
+# only has the fitted projection or ICA applied, which is linear and channel by channel, so it is
+# downsampled in the same pass as the filtering (same samples as filtering and downsampling separately)
+new_sfreq = 500
 
-# Parcellate_Source_Data
-compute_source.parcellate_source_data(src, stc, subject, fs_dir, output_dir, Vol)
+# Noise covariances of the empty room recordings, see compute_noise_cov below
+# Many subjects share empty room sessions, so noise covariances go to a store shared by all subjects
+# (and concurrent jobs), keyed by the empty room file contents and the preprocessing recipe
+noise_cov_store = os.path.join(data_dir, 'processed_meg', 'noise_cov_store')
+er_recipe = dict(l_freq=l_freq, h_freq=h_freq, new_sfreq=new_sfreq, engine='fused')
+
+def run_subject(subject, n_cpu=16):
+	# Run the whole pipeline for one subject on n_cpu cores
+	# Each stage uses them either as joblib jobs or as BLAS threads, and its CPU efficiency is recorded
+	records = []
+
+	# Identify the files to process for this subject
+	raw_fname = os.path.join(rest_raw_dname, subject, 'mf2pt2_' + subject + '_ses-rest_task-rest_meg.fif')
+	er_fname = os.path.join(er_dname, subject, 'emptyroom/emptyroom_' + subject[4:] + '.fif')
+	trans = os.path.join(trans_dname, subject + '-trans.fif')
+
+	# We want to save output at various points in the pipeline
+	output_dir = os.path.join(data_dir, 'processed_meg', subject)
+	if not os.path.isdir(output_dir):
+		os.mkdir(output_dir)
+
+	# Intermediate results are cached under the output directory, keyed by a hash of their inputs and
+	# parameters, so a rerun (e.g. after a SLURM timeout) resumes from the last finished stage
+	cache_dir = os.path.join(output_dir, 'cache')
+
+	# HDF5 output store, None to save separate files
+	store = output_store.store_fname(output_dir) if output_format == 'hdf5' else None
+
+	def read_and_filter():
+		# Read resting-state data
+		# Only the 30-390 s window and the channels used below are read from the file
+		if ICA:
+			picks = ['meg', 'eog', 'ecg']
+		else:
+			picks = ['grad', 'eog', 'ecg']
+		with scheduler.stage('filter', n_cpu, records) as n_jobs:
+			raw = preprocess.read_data(raw_fname, tmin=30, tmax=390, picks=picks)
+			raw.del_proj()                          # Don't want existing projectors, could add to preprocess.read_data() if we never want them
+			return preprocess.filter_resample_data(raw,l_freq=l_freq,h_freq=h_freq,n_jobs=n_jobs)
+
+	filtered_key = stage_cache.stage_key('filtered', inputs=[raw_fname], params=dict(tmin=30, tmax=390, ICA=ICA, l_freq=l_freq, h_freq=h_freq, engine='fused'))
+
+	def load_filtered():
+		return stage_cache.run_stage(cache_dir, 'filtered', filtered_key, 'raw', read_and_filter)
+
+	ica_key = stage_cache.stage_key('ica', params=dict(method='picard'), parents=[filtered_key])
+
+	def load_ica():
+		# do_ICA also applies the ICA, so fit it on a separate load of the filtered data
+		def fit_ica():
+			raw = load_filtered()
+			with scheduler.stage('ica', n_cpu, records):
+				pick_meg = mne.pick_types(raw.info, meg=True, eeg=False, stim=False, ref_meg=False)
+				raw, ica = preprocess.do_ICA(raw, picks=pick_meg, method = "picard")
+			return ica
+		return stage_cache.run_stage(cache_dir, 'ica', ica_key, 'ica', fit_ica)
+
+	def remove_artifacts():
+		raw = load_filtered()
+		if ICA:
+			ica = load_ica()
+		# Remove heartbeat and eye movement artifacts
+		with scheduler.stage('artifacts', n_cpu, records):
+			if ICA:
+				ica.apply(raw)
+			else:
+				raw, _ = preprocess.add_ecg_eog_projectors(raw)
+		# Downsample the corrected data
+		with scheduler.stage('filter', n_cpu, records) as n_jobs:
+			return preprocess.resample_filtered_data(raw,new_sfreq,l_freq=l_freq,h_freq=h_freq,n_jobs=n_jobs)
+
+	clean_key = stage_cache.stage_key('clean', params=dict(ICA=ICA, new_sfreq=new_sfreq), parents=[filtered_key] + ([ica_key] if ICA else []))
+	raw = stage_cache.run_stage(cache_dir, 'clean', clean_key, 'raw', remove_artifacts)
+
+	# Save processed Raw data
+
+	if store:
+		output_store.write_raw(store, raw, provenance=output_store.provenance(subject=subject, raw_fname=raw_fname, stage_key=clean_key,
+		                                                                      ICA=ICA, l_freq=l_freq, h_freq=h_freq, new_sfreq=new_sfreq))
+	else:
+		raw.save(os.path.join(output_dir, 'sensor_processed_meg.fif'), overwrite=True)
+
+	# Compute data covariance from two minutes of raw recording
+	if ICA:
+		raw.pick('grad')
+
+	data_cov_key = stage_cache.stage_key('data_cov', params=dict(tmin=30, tmax=150), parents=[clean_key])
+	data_cov = stage_cache.run_stage(cache_dir, 'data_cov', data_cov_key, 'cov',
+	                                 scheduler.staged('data_cov', n_cpu, records, lambda n_jobs: preprocess.compute_streaming_covariance(raw, tmin=30, tmax=150, n_jobs=n_jobs)))
+
+	# Compute noise covariance from empty room recording
+
+	def compute_noise_cov():
+		# Streamed in chunks, each read with enough extra data on both sides for the filter
+		er_raw = mne.io.read_raw_fif(er_fname, preload=False)
+		margin = preprocess.filter_margin(er_raw.info['sfreq'], l_freq=l_freq, h_freq=h_freq)
+		if ICA:
+			ica = load_ica()
+		def process(er_raw):
+			mne.channels.fix_mag_coil_types(er_raw.info)
+			if ICA:
+				er_raw.pick(['meg'])	# I realize that this doesn' make sense but I need the mags for the ICA
+			else:
+				er_raw.pick(['grad'])
+			er_raw.del_proj()
+			er_raw = preprocess.filter_resample_data(er_raw,l_freq=l_freq,h_freq=h_freq,sfreq=new_sfreq)
+			if ICA:
+				ica.apply(er_raw)
+				er_raw.pick(['grad'])
+			return er_raw
+		with scheduler.stage('noise_cov', n_cpu, records) as n_jobs:
+			return preprocess.compute_streaming_covariance(er_raw, process=process, margin=margin, n_jobs=n_jobs)
+
+	if ICA:
+		# ICA is fitted to each subject, so the key includes a fingerprint of the fitted ICA
+		ica = load_ica()
+		ica_fingerprint = stage_cache.fingerprint(ica.pre_whitener_, ica.pca_mean_, ica.pca_components_, ica.unmixing_matrix_,
+		                                          ica.mixing_matrix_, sorted(ica.exclude), ica.n_components_)
+		noise_cov_key = stage_cache.stage_key('noise_cov_ica', inputs=[er_fname], params=er_recipe, parents=[ica_fingerprint])
+		noise_cov = stage_cache.run_stage(noise_cov_store, 'noise_cov_ica', noise_cov_key, 'cov', compute_noise_cov)
+	else:
+		# SSP projection is linear, so the store holds the unprojected covariance (shared by every subject
+		# with this empty room recording) and each subject's projectors are applied to it directly
+		noise_cov_key = stage_cache.stage_key('noise_cov', inputs=[er_fname], params=er_recipe)
+		noise_cov = stage_cache.run_stage(noise_cov_store, 'noise_cov', noise_cov_key, 'cov', compute_noise_cov)
+		noise_cov = preprocess.project_noise_cov(noise_cov, raw.info)
+
+	# Make boundary element model (BEM) surfaces if there isn't already a file
+	if not os.path.isfile(fs_dir + '/' + subject + '/bem/watershed/' + subject + '-meg-bem.fif'):
+	    mne.bem.make_watershed_bem(subject, subjects_dir=fs_dir, overwrite=True)
+
+	# This section requires previously-computed BEM surfaces to be in the FreeSurfer directory
+	# Set up forward solution
+	bem_key = stage_cache.stage_key('bem', inputs=[os.path.join(fs_dir, subject, 'bem', 'inner_skull.surf')], params=dict(ico=4, conductivity=(0.3,)))
+	bem = stage_cache.run_stage(cache_dir, 'bem', bem_key, 'bem', scheduler.staged('bem', n_cpu, records, lambda n_jobs: compute_source.make_bem(subject, fs_dir)))
+
+	if Vol:
+		src_key = stage_cache.stage_key('src', params=dict(Vol=Vol), parents=[bem_key])
+		src = stage_cache.run_stage(cache_dir, 'src', src_key, 'src',
+		                            scheduler.staged('src', n_cpu, records, lambda n_jobs: mne.setup_volume_source_space(subject=subject, subjects_dir=fs_dir, bem=bem, n_jobs=n_jobs)))
+	else:
+		src_key = stage_cache.stage_key('src', inputs=[os.path.join(fs_dir, subject, 'surf', hemi + surf) for hemi in ('lh', 'rh') for surf in ('.white', '.sphere')], params=dict(Vol=Vol))
+		src = stage_cache.run_stage(cache_dir, 'src', src_key, 'src',
+		                            scheduler.staged('src', n_cpu, records, lambda n_jobs: mne.setup_source_space(subject, subjects_dir=fs_dir, n_jobs=n_jobs)))
+
+	# The forward solution only depends on the sensors (positions from the raw file, the channels picked) and
+	# the head model, not on how the data was cleaned, so changing the cleaning recipe doesn't recompute it
+	sensors_fingerprint = stage_cache.fingerprint(raw.info['ch_names'])
+	fwd_key = stage_cache.stage_key('fwd', inputs=[raw_fname, trans], params=dict(mindist=5.0), parents=[sensors_fingerprint, src_key, bem_key])
+	fwd = stage_cache.run_stage(cache_dir, 'fwd', fwd_key, 'fwd',
+	                            scheduler.staged('fwd', n_cpu, records, lambda n_jobs: mne.make_forward_solution(raw.info, trans=trans, src=src, bem=bem, meg=True, eeg=False, mindist=5.0, n_jobs=n_jobs)))
+	if store:
+		output_store.write_source_space(store, [s['vertno'] for s in fwd['src']], src)
+	else:
+		src.save(os.path.join(output_dir, 'src_beamformer-src.fif'), overwrite=True)
+
+	start, stop = raw.time_as_index([30, 390])
+	if lcmv_sweep:
+		# All the settings share the eigendecomposition of the data covariance and the whitened leadfield,
+		# and their parcel time series are computed in one pass over the data
+		with scheduler.stage('lcmv', n_cpu, records):
+			sweep_filts = compute_source.make_lcmv_sweep(raw.info, fwd, data_cov, lcmv_sweep)
+		with scheduler.stage('parcellation', n_cpu, records):
+			compute_source.parcellate_lcmv_sweep(raw, sweep_filts, lcmv_sweep, src, subject, fs_dir, output_dir, Vol=Vol, start=start, stop=stop,
+			                                     store=store, provenance=output_store.provenance(subject=subject, fwd_key=fwd_key, data_cov_key=data_cov_key))
+	else:
+		# Compute the spatial filter
+		lcmv_params = dict(reg=0.05, noise_cov=None, pick_ori='max-power', weight_norm='unit-noise-gain', rank='info')
+		lcmv_key = stage_cache.stage_key('lcmv', params=lcmv_params, parents=[fwd_key, data_cov_key])
+		filts = stage_cache.run_stage(cache_dir, 'lcmv', lcmv_key, 'lcmv',
+		                              scheduler.staged('lcmv', n_cpu, records, lambda n_jobs: mne.beamformer.make_lcmv(raw.info, fwd, data_cov, **lcmv_params)))
+
+		# pick_ori=None, weight_norm=None, depth=None, rank=None) #Vasily's settings
+		lcmv_provenance = output_store.provenance(subject=subject, lcmv=lcmv_params, stage_key=lcmv_key)
+
+		if fused_parcellation:
+			# Fold the parcellation into the beamformer weights and apply it straight to the sensor data
+			with scheduler.stage('parcellation', n_cpu, records):
+				compute_source.parcellate_fused_lcmv(raw, filts, src, subject, fs_dir, output_dir, Vol=Vol, start=start, stop=stop,
+				                                     store=store, provenance=lcmv_provenance)
+
+		if save_stc or not fused_parcellation:
+			# Apply beamformer
+			with scheduler.stage('apply', n_cpu, records):
+				stc = mne.beamformer.apply_lcmv_raw(raw, filts, start=start, stop=stop)
+			if save_stc and store:
+				output_store.write_stc(store, stc, src, provenance=lcmv_provenance)
+			elif save_stc:
+				stc.save(os.path.join(output_dir, 'stc_beamformer'), overwrite=True)
+			if not fused_parcellation:
+				# Parcellate_Source_Data
+				with scheduler.stage('parcellation', n_cpu, records):
+					compute_source.parcellate_source_data(src, stc, subject, fs_dir, output_dir, Vol, store=store, provenance=lcmv_provenance)
+
+	# Time, memory and CPU efficiency of the stages computed in this run (not loaded from the cache)
+	profiling.write_profile(records, os.path.join(output_dir, 'profile.json'), subject=subject, n_cpu=n_cpu)
+
+
+if __name__ == '__main__':
+	# Check if a subject is passed
+
+	if len(sys.argv) <= 1:
+	    raise ValueError("A subject directory has not been provided. Usage:"
+	                     "\n\tpython pipeline_rest_beamformer.py <subject_name>")
+	else:
+	    subject = sys.argv[1]
+
+	# Use the cores allocated to the job, divided between parallel jobs and BLAS threads stage by stage
+	run_subject(subject, n_cpu=scheduler.available_cpus())
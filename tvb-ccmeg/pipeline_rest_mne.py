@@ -11,22 +11,15 @@
 import mne              # Need MNE Python
 import preprocess       # Module with all the preprocessing functions
 import compute_source   # Module with functions to go from sensor space to source space
+import stage_cache      # Module with functions to cache intermediate results between runs
+import scheduler        # Module with functions to share the cores between parallel jobs and BLAS threads
+import profiling        # Module with functions to record the time and memory used by each stage
+import output_store     # Module with functions to write the time series to one HDF5 file per subject
+import qc               # Module with functions to write quality control summaries and render them as reports
 import numpy as np      # Need for array operations
 import os
 import sys
 
-# Check if a subject is passed
-
-if len(sys.argv) <= 1:
-    raise ValueError("A subject directory has not been provided. Usage:"
-                     "\n\tpython pipeline_test.py <subject_directory_name>")
-else:
-    subject = sys.argv[1]
-
-# Set number of cores for parallel processing (must be done before running any linear algebra functions)
-num_cpu = '16'
-os.environ['OMP_NUM_THREADS'] = num_cpu
-
 # Identify user's home directory
 home_dir = os.path.expanduser('~')
 
@@ -39,116 +32,176 @@ rest_raw_dname = os.path.join(home_dir, 'projects/def-rmcintos/Cam-CAN/meg/relea
 er_dname = os.path.join(home_dir, 'projects/def-rmcintos/Cam-CAN/meg/release005/BIDSsep/meg_emptyroom/')
 trans_dname = os.path.join(home_dir, 'projects/def-rmcintos/Cam-CAN/meg/release005/BIDSsep/trans-halifax/')
 fs_dir = os.path.join(home_dir, 'projects/ctb-rmcintos/data-sets/Cam-CAN/freesurfer/')
-raw_fname = os.path.join(rest_raw_dname, subject, 'ses-rest/meg', subject + '_ses-rest_task-rest_meg.fif')
-er_fname = os.path.join(er_dname, subject, 'emptyroom/emptyroom_' + subject[4:] + '.fif')
-trans = os.path.join(trans_dname, subject + '-trans.fif')
-
-# We want to save output at various points in the pipeline
-output_dir = os.path.join(home_dir,'projects/ctb-rmcintos/data-sets/Cam-CAN/processed_meg', subject)
-if not os.path.isdir(output_dir):
-	os.mkdir(output_dir)
-
-# Preprocessing:
-
-# Generate MNE Python report for visual quality control
-report = mne.Report(title=subject+'_QC_report', raw_psd=True)
-
-# Read resting-state data
-raw = preprocess.read_data(raw_fname)
-raw.del_proj()                          # Don't want existing projectors, could add to preprocess.read_data() if we never want them
-# Add raw data to report
-report.add_raw(raw=raw, title='Raw')
-
-# Compute head position throughout recording
-head_pos = preprocess.compute_head_position(raw)
-# Write head position to file (takes a while to compute) and add visualization to report
-mne.chpi.write_head_pos(os.path.join(output_dir, 'head_pos.pos'), head_pos)
-report.add_figure(fig=mne.viz.plot_head_positions(head_pos, mode='traces', show=False), title='Head Motion')
-
-# Apply Maxwell filtering without head motion correction
-raw = preprocess.maxwell_filter(raw, calibration, cross_talk)
-# Add Maxwell filtered PSD to report
-report.add_figure(fig=raw.compute_psd(fmax=350).plot(show=False), title='Maxwell Filtered')
-
-# Filter data to remove line noise, slow drifts, and frequencies too high to be of interest
-raw = preprocess.filter_data(raw)
-# Add filtered PSD to report
-report.add_figure(fig=raw.compute_psd(fmax=350).plot(show=False), title='Filtered')
-
-# Remove heartbeat artifacts
-# Currently uses SSP, might be better (but slower) with ICA
-# Define epochs based on heartbeat artifacts
-ecg_epochs = mne.preprocessing.create_ecg_epochs(raw)
-# Add plot of artifacts to report
-ecg_before = ecg_epochs.average().apply_baseline(baseline=(None, -0.2))
-report.add_evokeds(evokeds=ecg_before, titles='ECG Before')
-# Calculate and add ECG projectors
-raw = preprocess.add_ecg_projectors(raw)
-# Add plot of corrected ECG epochs to report
-ecg_after = mne.Epochs(raw, ecg_epochs.events, tmin=-0.5, tmax=0.5)
-ecg_after = ecg_after.average().apply_baseline(baseline=(None, -0.2))
-report.add_evokeds(evokeds=ecg_after, titles='ECG After')
-
-# Remove ocular artifacts
-# Currently uses SSP, might be better (but slower) with ICA
-# Define epochs based on ocular artifacts
-eog_epochs = mne.preprocessing.create_eog_epochs(raw)
-# Add plot of artifacts to report
-eog_before = eog_epochs.average().apply_baseline(baseline=(None, -0.2))
-report.add_evokeds(evokeds=eog_before, titles='EOG Before')
-# Calculate and add EOG projectors
-raw = preprocess.add_eog_projectors(raw)
-# Add plot of corrected EOG epochs to report
-eog_after = mne.Epochs(raw, eog_epochs.events, tmin=-0.5, tmax=0.5)
-eog_after = eog_after.average().apply_baseline(baseline=(None, -0.2))
-report.add_evokeds(evokeds=eog_after, titles='EOG After')
-
-# Save preprocessed MEG data
-raw.save(os.path.join(output_dir, 'test_preprocessed.fif'), overwrite=True)
-
-# Save report
-report.save(os.path.join(output_dir, 'report.html'), overwrite=True)
-
-# Calculate noise covariance from empty room data (need this for MNE)
-noise_cov = preprocess.compute_noise_cov(er_fname, raw, calibration, cross_talk)
-# Write noise covariance to file
-mne.write_cov(os.path.join(output_dir, 'er-cov.fif'), noise_cov, overwrite=True)
-
-# Estimate source activity
-
-# Make boundary element model (BEM) surfaces if there isn't already a file
-if not os.path.isfile(os.path.join(fs_dir, subject, 'bem/watershed', subject + '-meg-bem.fif')):
-    mne.bem.make_watershed_bem(subject, subjects_dir=fs_dir, overwrite=True)
-
-# This section requires previously-computed BEM surfaces to be in the FreeSurfer directory
-# Setup source space
-src = compute_source.setup_source_space(subject, fs_dir)
-# Save source space
-mne.write_source_spaces(os.path.join(output_dir, 'test_src.fif'), src, overwrite=True)
-# Make boundary element model (BEM)
-bem = compute_source.make_bem(subject, fs_dir)
-# Save BEM
-mne.write_bem_solution(os.path.join(output_dir, 'test_bem.h5'), bem, overwrite=True)
-
-# Make inverse operator to go from sensor to source space
-inverse_operator = compute_source.make_inverse_operator(raw, raw_fname, trans, src, bem, noise_cov)
-# Save inverse operator
-mne.minimum_norm.write_inverse_operator(os.path.join(output_dir, 'test_inv.fif'), inverse_operator, overwrite=True)
-
-# Estimate source activity
-# First downsample to 300 Hz to avoid running out of memory when computing full source reconstruction
-raw.resample(300)
-
-stc = compute_source.compute_inverse_solution_rest(raw, inverse_operator)
-
-#   Write source activity to file
-# stc.save(os.pathn.join(output_dir, 'stc_test'), overwrite=True)
-
-# Estimate source activity in parcellated brain
-
-# Read labels from parcellation file
-labels = mne.read_labels_from_annot(subject, parc='Schaefer2018_200Parcels_17Networks_order', subjects_dir=fs_dir)
-# Extract timeseries for parcellation ('mean' option avoids cancellation from default 'mean_flip' since MNE source activity is not signed)
-parc_ts = mne.extract_label_time_course(stc, labels, src, mode='mean')
-# Save parcellated time series to file
-np.save(os.path.join(output_dir, 'parc_ts_test'), parc_ts)
+
+# Output format: 'files' saves test_preprocessed.fif and parc_ts_test.npy, 'hdf5' writes the sensor and
+# parcel time series as compressed float32 arrays to one file, outputs.h5 (see output_store.py)
+output_format = 'files'
+
+# Quality control: each stage writes a compact summary to qc/ in the output directory (spectra of a subsample
+# of channels, averages around heartbeats and blinks, head position traces). The report is rendered from them
+# afterwards, for many subjects at once, with python qc.py <processed_meg_dir> <subject_list.txt> [<n_workers>]
+write_qc = True
+
+def run_subject(subject, n_cpu=16):
+	# Run the whole pipeline for one subject on n_cpu cores
+	# Each stage uses them either as joblib jobs or as BLAS threads, and its CPU efficiency is recorded
+	records = []
+
+	# Identify the files to process for this subject
+	raw_fname = os.path.join(rest_raw_dname, subject, 'ses-rest/meg', subject + '_ses-rest_task-rest_meg.fif')
+	er_fname = os.path.join(er_dname, subject, 'emptyroom/emptyroom_' + subject[4:] + '.fif')
+	trans = os.path.join(trans_dname, subject + '-trans.fif')
+
+	# We want to save output at various points in the pipeline
+	output_dir = os.path.join(home_dir,'projects/ctb-rmcintos/data-sets/Cam-CAN/processed_meg', subject)
+	if not os.path.isdir(output_dir):
+		os.mkdir(output_dir)
+
+	# Intermediate results are cached under the output directory, keyed by a hash of their inputs and
+	# parameters, so a rerun (e.g. after a SLURM timeout) resumes from the last finished stage
+	cache_dir = os.path.join(output_dir, 'cache')
+
+	# HDF5 output store, None to save separate files
+	store = output_store.store_fname(output_dir) if output_format == 'hdf5' else None
+
+	# Preprocessing:
+
+	# Head position and Maxwell filtering are the only stages that use the raw data
+	head_pos_key = stage_cache.stage_key('head_pos', inputs=[raw_fname])
+	sss_key = stage_cache.stage_key('sss', inputs=[raw_fname, calibration, cross_talk])
+
+	# Read resting-state data
+	# Only when one of them isn't cached, so a rerun that resumes after the Maxwell filtering doesn't read
+	# the recording (nor summarize it again for quality control)
+	if not (stage_cache.is_cached(cache_dir, 'head_pos', head_pos_key) and stage_cache.is_cached(cache_dir, 'sss', sss_key)):
+		raw = preprocess.read_data(raw_fname)
+		raw.del_proj()                          # Don't want existing projectors, could add to preprocess.read_data() if we never want them
+		# Summarize raw data for quality control
+		if write_qc:
+			with scheduler.stage('qc', n_cpu, records):
+				qc.write_psd(output_dir, 'raw', 'Raw', raw)
+
+	# Compute head position throughout recording (windows of the recording are fit in parallel)
+	head_pos = stage_cache.run_stage(cache_dir, 'head_pos', head_pos_key, 'head_pos', scheduler.staged('head_pos', n_cpu, records, lambda n_jobs: preprocess.compute_head_position(raw, n_jobs=n_jobs)))
+	# Write head position to file (takes a while to compute)
+	mne.chpi.write_head_pos(os.path.join(output_dir, 'head_pos.pos'), head_pos)
+	if write_qc:
+		qc.write_head_pos(output_dir, 'head_pos', 'Head Motion', head_pos)
+
+	# Apply Maxwell filtering without head motion correction
+	raw = stage_cache.run_stage(cache_dir, 'sss', sss_key, 'raw', scheduler.staged('sss', n_cpu, records, lambda n_jobs: preprocess.maxwell_filter(raw, calibration, cross_talk)))
+	if write_qc:
+		with scheduler.stage('qc', n_cpu, records):
+			qc.write_psd(output_dir, 'sss', 'Maxwell Filtered', raw)
+
+	# Filter data to remove line noise, slow drifts, and frequencies too high to be of interest
+	filtered_key = stage_cache.stage_key('filtered', params=dict(l_freq=0.1, h_freq=100, line_freqs=(50, 100), engine='fused'), parents=[sss_key])
+	raw = stage_cache.run_stage(cache_dir, 'filtered', filtered_key, 'raw', scheduler.staged('filter', n_cpu, records, lambda n_jobs: preprocess.filter_resample_data(raw, n_jobs=n_jobs)))
+	if write_qc:
+		with scheduler.stage('qc', n_cpu, records):
+			qc.write_psd(output_dir, 'filtered', 'Filtered', raw)
+
+	# Remove heartbeat and ocular artifacts
+	# Currently uses SSP, might be better (but slower) with ICA
+	# Events, projectors and the projection are computed in one pass, which also returns the averages
+	# around the events before and after correction. They are cached with the corrected data, so quality
+	# control only reads them back and never has to epoch the data again
+	artifact_key = stage_cache.stage_key('artifact_proj', parents=[filtered_key])
+	evokeds_key = stage_cache.stage_key('artifact_evokeds', parents=[artifact_key])
+	def remove_artifacts():
+		raw_clean, evokeds = preprocess.add_ecg_eog_projectors(raw)
+		# Written before the corrected data, so they are in the cache whenever it is
+		stage_cache.run_stage(cache_dir, 'artifact_evokeds', evokeds_key, 'evokeds', lambda: evokeds)
+		return raw_clean
+	raw_clean = stage_cache.run_stage(cache_dir, 'artifact_proj', artifact_key, 'raw', scheduler.staged('artifacts', n_cpu, records, lambda n_jobs: remove_artifacts()))
+	if write_qc:
+		with scheduler.stage('qc', n_cpu, records):
+			# Averages of the artifacts before and after correction (only computed here for corrected
+			# data cached before the averages were, and then cached too)
+			artifact_evokeds = stage_cache.run_stage(cache_dir, 'artifact_evokeds', evokeds_key, 'evokeds',
+			                                         lambda: preprocess.compute_artifact_evokeds(raw, raw_clean.info['projs']))
+			qc.write_artifact_evokeds(output_dir, artifact_evokeds)
+	raw = raw_clean
+
+	# Save preprocessed MEG data
+	if store:
+		output_store.write_raw(store, raw, provenance=output_store.provenance(subject=subject, raw_fname=raw_fname, stage_key=artifact_key))
+	else:
+		raw.save(os.path.join(output_dir, 'test_preprocessed.fif'), overwrite=True)
+
+	# Calculate noise covariance from empty room data (need this for MNE)
+	# Noise covariances go to a store shared by all subjects and concurrent jobs, keyed by the empty room
+	# file contents and the recipe. The empty room data is Maxwell filtered for this subject's head
+	# position and bad channels, and gets its projectors, so those are fingerprinted into the key too
+	noise_cov_store = os.path.join(os.path.dirname(output_dir), 'noise_cov_store')
+	er_fingerprint = stage_cache.fingerprint(raw.info['dev_head_t']['trans'], sorted(raw.info['bads']), raw.annotations.onset,
+	                                         raw.annotations.duration, list(raw.annotations.description), raw.info['projs'])
+	noise_cov_key = stage_cache.stage_key('noise_cov_sss', inputs=[er_fname, calibration, cross_talk], params=dict(engine='fused'), parents=[er_fingerprint])
+	noise_cov = stage_cache.run_stage(noise_cov_store, 'noise_cov_sss', noise_cov_key, 'cov', scheduler.staged('noise_cov', n_cpu, records, lambda n_jobs: preprocess.compute_noise_cov(er_fname, raw, calibration, cross_talk, n_jobs=n_jobs)))
+	# Write noise covariance to file
+	mne.write_cov(os.path.join(output_dir, 'er-cov.fif'), noise_cov, overwrite=True)
+
+	# Estimate source activity
+
+	# Make boundary element model (BEM) surfaces if there isn't already a file
+	if not os.path.isfile(os.path.join(fs_dir, subject, 'bem/watershed', subject + '-meg-bem.fif')):
+	    mne.bem.make_watershed_bem(subject, subjects_dir=fs_dir, overwrite=True)
+
+	# This section requires previously-computed BEM surfaces to be in the FreeSurfer directory
+	# Setup source space
+	src_key = stage_cache.stage_key('src', inputs=[os.path.join(fs_dir, subject, 'surf', hemi + surf) for hemi in ('lh', 'rh') for surf in ('.orig', '.sphere')], params=dict(spacing='oct6', surface='orig'))
+	src = stage_cache.run_stage(cache_dir, 'src', src_key, 'src', scheduler.staged('src', n_cpu, records, lambda n_jobs: compute_source.setup_source_space(subject, fs_dir, n_jobs=n_jobs)))
+	# Save source space
+	mne.write_source_spaces(os.path.join(output_dir, 'test_src.fif'), src, overwrite=True)
+	# Make boundary element model (BEM)
+	bem_key = stage_cache.stage_key('bem', inputs=[os.path.join(fs_dir, subject, 'bem', 'inner_skull.surf')], params=dict(ico=4, conductivity=(0.3,)))
+	bem = stage_cache.run_stage(cache_dir, 'bem', bem_key, 'bem', scheduler.staged('bem', n_cpu, records, lambda n_jobs: compute_source.make_bem(subject, fs_dir)))
+	# Save BEM
+	mne.write_bem_solution(os.path.join(output_dir, 'test_bem.h5'), bem, overwrite=True)
+
+	# Make inverse operator to go from sensor to source space
+	inv_key = stage_cache.stage_key('inv', inputs=[raw_fname, trans], params=dict(mindist=5.0, loose=0.2, depth=0.8), parents=[artifact_key, noise_cov_key, src_key, bem_key])
+	inverse_operator = stage_cache.run_stage(cache_dir, 'inv', inv_key, 'inv', scheduler.staged('fwd', n_cpu, records, lambda n_jobs: compute_source.make_inverse_operator(raw, raw_fname, trans, src, bem, noise_cov, n_jobs=n_jobs)))
+	# Save inverse operator
+	mne.minimum_norm.write_inverse_operator(os.path.join(output_dir, 'test_inv.fif'), inverse_operator, overwrite=True)
+
+	# Estimate source activity in parcellated brain
+
+	# Schaefer parcellation as a sparse (n_labels, n_sources) matrix, cached with the other stages
+	# ('mean' option avoids cancellation from default 'mean_flip' since MNE source activity is not signed)
+	index = compute_source.make_parcellation_index(inverse_operator['src'], [s['vertno'] for s in inverse_operator['src']], subject, fs_dir, cache_dir,
+	                                               parcellations=dict(Schaefer=compute_source.PARCELLATIONS['Schaefer']), mode='mean')
+
+	# Estimate source activity at the native sampling rate in 10 s blocks, reducing each block to the
+	# parcellation as it is computed so the full source reconstruction never has to fit in memory
+	tmin, tmax = 30, 330
+	start, stop = raw.time_as_index([tmin, tmax])
+	parc_ts = np.zeros((index['matrix'].shape[0], stop - start))
+	# Extract timeseries for parcellation, one sparse product per block
+	sink = compute_source.parcellation_sink(parc_ts, index)
+	#   To write source activity to file instead, pass compute_source.array_sink() a np.lib.format.open_memmap() array
+	with scheduler.stage('apply', n_cpu, records):
+		compute_source.compute_inverse_solution_rest(raw, inverse_operator, tmin=tmin, tmax=tmax, block_duration=10., sink=sink)
+
+	# Save parcellated time series to file
+	if store:
+		output_store.write_parcellations(store, dict(Schaefer=parc_ts), index['labels'], raw.info['sfreq'], tmin,
+		                                 provenance=output_store.provenance(subject=subject, method='dSPM', mode='mean', stage_key=inv_key))
+	else:
+		np.save(os.path.join(output_dir, 'parc_ts_test'), parc_ts)
+
+	# Time, memory and CPU efficiency of the stages computed in this run (not loaded from the cache)
+	profiling.write_profile(records, os.path.join(output_dir, 'profile.json'), subject=subject, n_cpu=n_cpu)
+
+
+if __name__ == '__main__':
+	# Check if a subject is passed
+
+	if len(sys.argv) <= 1:
+	    raise ValueError("A subject directory has not been provided. Usage:"
+	                     "\n\tpython pipeline_test.py <subject_directory_name>")
+	else:
+	    subject = sys.argv[1]
+
+	# Use the cores allocated to the job, divided between parallel jobs and BLAS threads stage by stage
+	run_subject(subject, n_cpu=scheduler.available_cpus())
@@ -9,26 +9,156 @@
 # License: Apache 2.0
 
 import mne
+import numpy as np
+import scipy.signal
+import copy
+import functools
+from fractions import Fraction
 
-def read_data(fname):
+def read_data(fname, tmin=None, tmax=None, picks=None):
     #Read in MEG data in fif format
-    raw = mne.io.read_raw_fif(fname, preload=True)  # Need to preload to filter
+    # Only the time window (in s) and channels that are kept are read from disk, cropping and picking
+    # are done before preloading so discarded data never goes through memory
+    raw = mne.io.read_raw_fif(fname, preload=False)
+    if tmin is not None or tmax is not None:
+        raw.crop(tmin=tmin or 0., tmax=tmax)
+    if picks is not None:
+        raw.pick(picks)
+    raw.load_data()  # Need to preload to filter
     #Fix channel labelling (may not be necessary depending on system, 
     # only has small effect anyways according to MNE-Python documentation)
     mne.channels.fix_mag_coil_types(raw.info)
     return raw
 
-def compute_noise_cov(er_fname, raw, calibration, cross_talk):
+def compute_noise_cov(er_fname, raw, calibration, cross_talk, n_jobs=None):
     # Important to apply the same preprocessing steps to empty room recording as subject recording
-    er_raw = read_data(er_fname)
+    # Streamed in chunks, so the empty room recording is never loaded in full
+    # It is prepared for Maxwell filtering before it is loaded (it is only read in process), so the chunks
+    # only need the subject's projectors rather than a copy of the whole subject recording each
+    er_raw = mne.io.read_raw_fif(er_fname, preload=False)
+    mne.channels.fix_mag_coil_types(er_raw.info)
     er_raw.del_proj()
     er_raw = mne.preprocessing.maxwell_filter_prepare_emptyroom(er_raw, raw=raw)
-    er_raw = mne.preprocessing.maxwell_filter(er_raw, calibration=calibration, cross_talk=cross_talk) 
-    er_raw = filter_data(er_raw)
-    er_raw.add_proj(raw.info['projs'])
-    noise_cov = mne.compute_raw_covariance(er_raw, tmin=0, tmax=None)
+    projs = raw.info['projs']
+    def process(er_raw):
+        er_raw = mne.preprocessing.maxwell_filter(er_raw, calibration=calibration, cross_talk=cross_talk)
+        er_raw = filter_resample_data(er_raw)    # Same filter as the subject recording
+        er_raw.add_proj(projs)
+        return er_raw
+    noise_cov = compute_streaming_covariance(er_raw, process=process, margin=filter_margin(er_raw.info['sfreq']), n_jobs=n_jobs)
     return noise_cov
 
+def compute_streaming_covariance(raw, tmin=None, tmax=None, tstep=0.2, process=None, margin=0., chunk_duration=60.,
+                                 reject_by_annotation=True, n_jobs=None):
+    # Drop-in for mne.compute_raw_covariance (empirical) that never loads the whole recording:
+    # raw can be a file name or an unloaded Raw, and is read chunk_duration seconds at a time
+    # process (e.g. filtering, projection, ICA) is applied to each chunk, read with margin seconds
+    # of extra data on both sides that are dropped afterwards (use at least half the filter length)
+    # Each chunk gives its count, mean and scatter matrix, merged with Chan et al.'s pairwise update
+    # Chunks are independent, so they are processed in parallel
+    if isinstance(raw, str):
+        raw = mne.io.read_raw_fif(raw, preload=False)
+    sfreq = raw.info['sfreq']
+    step = int(round(tstep * sfreq))
+    start = int(round((tmin or 0.) * sfreq))
+    stop = raw.n_times if tmax is None else min(int(round(tmax * sfreq)), raw.n_times)
+    stop = start + (stop - start) // step * step    # Whole tstep segments only, as compute_raw_covariance
+    # Chunks and margins are whole numbers of segments, so resampling in process stays aligned
+    chunk = max(int(round(chunk_duration / tstep)), 1) * step
+    pad = int(np.ceil(margin / tstep)) * step
+    bad_spans = []
+    if reject_by_annotation:
+        # (onset, end) in s from the first sample (annotations attached to a raw are kept relative to its
+        # first_time), compared unrounded with the segment edges as Epochs does
+        bad_spans = [(onset - raw.first_time, onset - raw.first_time + duration)
+                     for onset, duration, description in zip(raw.annotations.onset, raw.annotations.duration, raw.annotations.description)
+                     if description.lower().startswith('bad')]
+    parallel, p_fun, n_jobs = mne.parallel.parallel_func(_chunk_covariance, n_jobs)
+    stats = parallel(p_fun(raw, chunk_start, min(chunk_start + chunk, stop), pad, step, process, bad_spans)
+                     for chunk_start in range(start, stop, chunk))
+    n_samples, mean, scatter = 0, 0., 0.
+    for chunk_n, chunk_mean, chunk_scatter, ch_names, bads, projs in stats:
+        if chunk_n == 0:
+            continue
+        delta = chunk_mean - mean
+        total = n_samples + chunk_n
+        scatter = scatter + chunk_scatter + np.outer(delta, delta) * (n_samples * chunk_n / total)
+        mean = mean + delta * (chunk_n / total)
+        n_samples = total
+    if n_samples < 2:
+        raise ValueError('Not enough samples to compute a covariance')
+    return mne.Covariance(scatter / (n_samples - 1.), ch_names, bads, projs, nfree=n_samples - 1)
+
+def _chunk_covariance(raw, start, stop, pad, step, process, bad_spans):
+    # Sufficient statistics of one chunk (samples start to stop of raw)
+    read_start, read_stop = max(start - pad, 0), min(stop + pad, raw.n_times)
+    chunk = mne.io.RawArray(raw.get_data(start=read_start, stop=read_stop), raw.info, first_samp=raw.first_samp + read_start, verbose=False)
+    chunk.set_annotations(raw.annotations)
+    if process is not None:
+        chunk = process(chunk)
+    ratio = chunk.info['sfreq'] / raw.info['sfreq']
+    # Same channels as compute_raw_covariance: data channels, including bad ones
+    picks = mne.pick_types(chunk.info, meg=True, eeg=True, seeg=True, ecog=True, dbs=True, fnirs=True, ref_meg=False, exclude=[])
+    ch_names = [chunk.ch_names[pick] for pick in picks]
+    bads = [bad for bad in chunk.info['bads'] if bad in ch_names]
+    seg = int(round(step * ratio))
+    first = int(round((start - read_start) * ratio))
+    # Same rule as compute_raw_covariance's epochs: a segment is dropped if any BAD_ annotation overlaps it
+    sfreq = raw.info['sfreq']
+    keep = [k for k, seg_start in enumerate(range(start, stop, step))
+            if not any(bad_start < (seg_start + step) / sfreq and bad_stop > seg_start / sfreq for bad_start, bad_stop in bad_spans)]
+    if not keep:
+        return 0, None, None, ch_names, bads, chunk.info['projs']
+    data = chunk.get_data(picks, start=first, stop=first + (stop - start) // step * seg)
+    data = data.reshape(len(picks), -1, seg)[:, keep].reshape(len(picks), -1)
+    mean = data.mean(axis=1)
+    data -= mean[:, np.newaxis]
+    return data.shape[1], mean, data @ data.T, ch_names, bads, chunk.info['projs']
+
+def check_streaming_covariance(raw, cov, tmin=None, tmax=None, tstep=0.2, rtol=1e-6):
+    # Compare cov from compute_streaming_covariance with mne.compute_raw_covariance on the same preloaded
+    # raw (use data with BAD_ annotations, so the rejected segments are compared too)
+    expected = mne.compute_raw_covariance(raw, tmin=tmin, tmax=tmax, tstep=tstep, verbose=False)
+    if cov['nfree'] != expected['nfree']:
+        raise RuntimeError('Streaming covariance used ' + str(cov['nfree'] + 1) + ' samples, compute_raw_covariance '
+                           + str(expected['nfree'] + 1))
+    max_err = np.abs(cov.data - expected.data).max() / np.abs(expected.data).max()
+    if max_err > rtol:
+        raise RuntimeError('Streaming covariance differs from compute_raw_covariance (relative error ' + str(max_err) + ')')
+
+def project_noise_cov(noise_cov, info):
+    # Noise covariance of the empty room data after applying the projectors in info
+    # Projection is linear (P C P^T), so the unprojected covariance can be shared between subjects
+    # and only this cheap step depends on the subject's projectors
+    # The projector leaves bad channels out, so it is built with the empty room recording's bad channels
+    # (the covariance's), as when the projectors are applied to the empty room data
+    info = mne.pick_info(info, mne.pick_channels(info['ch_names'], noise_cov['names'], ordered=True))
+    with info._unlock():
+        info['projs'] = [_inactive(proj) for proj in info['projs']]
+        info['bads'] = list(noise_cov['bads'])
+    # Projection matrix exactly as MNE applies it, by projecting the identity
+    projector = mne.io.RawArray(np.eye(len(info['ch_names'])), info, verbose=False).apply_proj().get_data()
+    noise_cov = noise_cov.copy()
+    noise_cov['data'] = projector @ noise_cov['data'] @ projector.T
+    noise_cov['projs'] = [copy.deepcopy(proj) for proj in info['projs']]
+    for proj in noise_cov['projs']:
+        proj['active'] = True
+    return noise_cov
+
+def check_project_noise_cov(er_raw, info, rtol=1e-6):
+    # Compare project_noise_cov with the covariance of the empty room data with the projectors in info
+    # applied (use an empty room recording whose bad channels differ from those in info)
+    # Bad channels are kept in the covariances, as in compute_streaming_covariance
+    er_raw = er_raw.copy().del_proj()
+    picks = mne.pick_types(er_raw.info, meg=True, eeg=True, ref_meg=False, exclude=[])
+    noise_cov = project_noise_cov(mne.compute_raw_covariance(er_raw, picks=picks, verbose=False), info)
+    er_raw.add_proj([_inactive(proj) for proj in info['projs']]).apply_proj()
+    expected = mne.compute_raw_covariance(er_raw, picks=picks, verbose=False)
+    max_err = np.abs(noise_cov.data - expected.data).max() / np.abs(expected.data).max()
+    if max_err > rtol:
+        raise RuntimeError('Projected noise covariance differs from the covariance of the projected empty room '
+                           'data (relative error ' + str(max_err) + ')')
+
 def mark_bad_channels(raw):
     # Mark bad channels, necessary to avoid noise spreading in Maxwell filtering
     # Ideally, this would be done manually at the time of recording
@@ -37,15 +167,37 @@ def mark_bad_channels(raw):
     raw.info['bads'] = bads
     return raw
 
-def compute_head_position(raw):
-    # Compute head position indicator coil amplitudes (pretty slow)
-    chpi_amplitudes = mne.chpi.compute_chpi_amplitudes(raw)
-    # Compute head position indicator coil locations (pretty slow)
-    chpi_locs = mne.chpi.compute_chpi_locs(raw.info, chpi_amplitudes)
+def compute_head_position(raw, n_jobs=None, window=60., overlap=1.):
+    if n_jobs is None or n_jobs == 1:
+        # Compute head position indicator coil amplitudes (pretty slow)
+        chpi_amplitudes = mne.chpi.compute_chpi_amplitudes(raw)
+        # Compute head position indicator coil locations (pretty slow)
+        chpi_locs = mne.chpi.compute_chpi_locs(raw.info, chpi_amplitudes)
+    else:
+        # Fit coil amplitudes and locations for windows of the recording in parallel
+        # Each window is padded with overlap seconds of data on both sides so the fits near its
+        # edges see the same data as in a single pass, then only fits inside the window are kept
+        sfreq = raw.info['sfreq']
+        parallel, p_fun, n_jobs = mne.parallel.parallel_func(_fit_chpi_window, n_jobs)
+        windows = parallel(p_fun(_raw_window(raw, t_start - overlap, t_start + window + overlap),
+                                 raw.first_time + t_start, raw.first_time + t_start + window)
+                           for t_start in np.arange(0, raw.n_times / sfreq, window))
+        chpi_locs = {key: np.concatenate([locs[key] for locs in windows]) for key in windows[0]}
     # Compute head position (much faster than the last two steps)
     head_pos = mne.chpi.compute_head_pos(raw.info, chpi_locs)
     return head_pos
 
+def _raw_window(raw, tmin, tmax):
+    # Copy of a segment of preloaded data, without copying the whole recording first
+    start, stop = raw.time_as_index([max(tmin, 0), tmax])
+    stop = min(stop, raw.n_times)
+    return mne.io.RawArray(raw.get_data(start=start, stop=stop), raw.info, first_samp=raw.first_samp + start, verbose=False)
+
+def _fit_chpi_window(raw, tmin, tmax):
+    chpi_amplitudes = mne.chpi.compute_chpi_amplitudes(raw)
+    chpi_locs = mne.chpi.compute_chpi_locs(raw.info, chpi_amplitudes)
+    keep = (chpi_locs['times'] >= tmin) & (chpi_locs['times'] < tmax)
+    return {key: value[keep] for key, value in chpi_locs.items()}
 
 def maxwell_filter(raw, calibration, cross_talk, head_pos=None):
     # Fine calibration file?
@@ -69,6 +221,86 @@ def add_eog_projectors(raw):
     raw.apply_proj()
     return raw
 
+def add_ecg_eog_projectors(raw):
+    # Heartbeat and ocular artifact removal in one stage: events are found once, both sets of
+    # projectors share one filtered copy of the data and the data is projected once
+    # Also returns averages around the events before and after projection for quality control
+    ecg_events, eog_events = find_artifact_events(raw)
+    projs = compute_artifact_projectors(raw, ecg_events, eog_events)
+    evokeds = compute_artifact_evokeds(raw, projs, ecg_events, eog_events)
+    raw.add_proj(projs)
+    raw.apply_proj()
+    return raw, evokeds
+
+def find_artifact_events(raw):
+    # Each detector only filters its own ECG/EOG channel, not the MEG data
+    ecg_events, _, _ = mne.preprocessing.find_ecg_events(raw)
+    eog_events = mne.preprocessing.find_eog_events(raw)
+    return ecg_events, eog_events
+
+def compute_artifact_projectors(raw, ecg_events, eog_events):
+    # Same settings as the compute_proj_ecg and compute_proj_eog defaults (1-35 Hz, 2 grad + 2 mag
+    # vectors from the average), but the MEG/ECG/EOG channels are copied and filtered only once
+    picks = mne.pick_types(raw.info, meg=True, eog=True, ecg=True, exclude='bads')
+    raw_filt = mne.io.RawArray(raw.get_data(picks), mne.pick_info(raw.info, picks), first_samp=raw.first_samp, verbose=False)
+    raw_filt.set_annotations(raw.annotations)   # Epochs overlapping BAD_ segments are rejected, as in compute_proj_ecg/eog
+    raw_filt.filter(1., 35., picks='all', filter_length='10s', l_trans_bandwidth=0.5, h_trans_bandwidth=0.5,
+                    phase='zero-double', fir_design='firwin2')
+    ch_types = set(raw_filt.get_channel_types())
+    projs = []
+    for mode, events, tmin, tmax, reject in (('ECG', ecg_events, -0.2, 0.4, dict(grad=2000e-13, mag=3000e-15, eog=250e-6)),
+                                             ('EOG', eog_events, -0.2, 0.2, dict(grad=2000e-13, mag=3000e-15))):
+        if len(events) == 0:
+            print("No " + mode + " events found\n")
+            continue
+        reject = {ch_type: value for ch_type, value in reject.items() if ch_type in ch_types}
+        # Projectors already found are applied to the epochs, so the EOG projectors are computed
+        # from ECG-corrected data as when the two were applied one after the other
+        epochs = mne.Epochs(raw_filt, events, None, tmin, tmax, baseline=None, reject=reject, proj=True, preload=True)
+        if len(epochs) == 0:
+            print("No good " + mode + " epochs found\n")
+            continue
+        mode_projs = mne.compute_proj_evoked(epochs.average(), n_grad=2, n_mag=2, n_eeg=2, meg='separate')
+        for proj in mode_projs:
+            proj['desc'] = mode + '-' + proj['desc']
+        raw_filt.add_proj(mode_projs)
+        projs.extend(mode_projs)
+    return projs
+
+def check_artifact_projectors(raw, projs, rtol=1e-6):
+    # Compare the data projected with the combined projectors with add_ecg_projectors followed by
+    # add_eog_projectors on a copy of the unprojected raw (use data with BAD_ annotations)
+    expected = add_eog_projectors(add_ecg_projectors(raw.copy()))
+    combined = raw.copy().add_proj(projs).apply_proj()
+    picks = mne.pick_types(raw.info, meg=True, exclude=[])
+    expected, combined = expected.get_data(picks), combined.get_data(picks)
+    max_err = np.abs(combined - expected).max() / np.abs(expected).max()
+    if max_err > rtol:
+        raise RuntimeError('Combined ECG/EOG projectors differ from add_ecg_projectors + '
+                           'add_eog_projectors (relative error ' + str(max_err) + ')')
+
+def compute_artifact_evokeds(raw, projs, ecg_events=None, eog_events=None):
+    # Averages around heartbeats and eye movements of the uncorrected data, and the same averages
+    # after projection (projection is linear, so the data does not need to be epoched again)
+    if ecg_events is None or eog_events is None:
+        ecg_events, eog_events = find_artifact_events(raw)
+    evokeds = dict()
+    for mode, events in (('ECG', ecg_events), ('EOG', eog_events)):
+        if len(events) == 0:
+            continue
+        before = mne.Epochs(raw, events, None, tmin=-0.5, tmax=0.5, baseline=None, proj=False).average()
+        before.apply_baseline(baseline=(None, -0.2))
+        after = before.copy()
+        after.add_proj([_inactive(proj) for proj in projs])
+        after.apply_proj()
+        evokeds[mode] = (before, after)
+    return evokeds
+
+def _inactive(proj):
+    proj = copy.deepcopy(proj)
+    proj['active'] = False
+    return proj
+
 def remove_eog_ecg(ica, raw):
     eog_indices, eog_scores = ica.find_bads_eog(raw)
     ecg_indices, ecg_scores = ica.find_bads_ecg(raw, method='correlation')  # Default method 'ctps' identified too many components as heartbeat artifacts
@@ -84,6 +316,122 @@ def filter_data(raw, l_freq=0.1, h_freq=100, line_freqs=(50,100)):
     raw.filter(l_freq=l_freq, h_freq=h_freq, picks=meg_picks) #Bandpass filter data (probably not any detectable high gamma activity in resting state because SNR is too low)
     return raw
 
+def filter_resample_data(raw, l_freq=0.1, h_freq=100, line_freqs=(50,100), sfreq=None, n_jobs=None):
+    # Same filtering as filter_data, plus optional downsampling to sfreq, in one pass over the data
+    # The notch and bandpass filters are combined into one FIR filter (designed once per set of parameters),
+    # and when the lowpass already removes everything above the new Nyquist frequency the data are
+    # decimated directly instead of going through another anti-aliasing filter
+    # Otherwise they go through scipy's polyphase resampler, as raw.resample(sfreq, method='polyphase'). That
+    # is not MNE's default FFT resampling: filter_data() then raw.resample(sfreq) gives different samples,
+    # about 3% relative error at 300 Hz on the synthetic recordings of benchmark_suite.py, even away from
+    # the edges (decimation, e.g. 1000 to 500 Hz, agrees with it to better than 0.01%)
+    # The MEG channels are filtered block by block, into the data in place or into the resampled output
+    # Use the same parameters for the subject and empty room recordings so they are filtered identically
+    h, up, down, decimate = design_fused_filter(raw.info['sfreq'], l_freq, h_freq, tuple(line_freqs), sfreq)
+    meg_picks = mne.pick_types(raw.info, meg=True)  #Only filter MEG channels
+    if sfreq is None or (up == 1 and down == 1):
+        # Filtered in place, like raw.filter()
+        raw.load_data()
+        _filter_blocks(raw, meg_picks, raw._data, h, 1, 1, raw.n_times, False, None, n_jobs)
+        with raw.info._unlock():    # Keep the filter settings in the measurement info like raw.filter() does
+            raw.info['highpass'] = max(raw.info['highpass'], l_freq or 0)
+            raw.info['lowpass'] = min(raw.info['lowpass'], h_freq or raw.info['lowpass'])
+        return raw
+    return _resample_data(raw, meg_picks, sfreq, h, up, down, decimate, l_freq, h_freq, n_jobs)
+
+def resample_filtered_data(raw, sfreq, l_freq=0.1, h_freq=100, line_freqs=(50,100), n_jobs=None):
+    # Second half of filter_resample_data(..., sfreq=sfreq) for data it already filtered at the original
+    # rate, e.g. so artifacts are estimated before downsampling. Use the same filter parameters: the MEG
+    # channels are padded by the same amount and go through the same decimation or polyphase resampler,
+    # so the samples are the same as the single pass (to rounding), edges included
+    h, up, down, decimate = design_fused_filter(raw.info['sfreq'], l_freq, h_freq, tuple(line_freqs), sfreq)
+    meg_picks = mne.pick_types(raw.info, meg=True)
+    if up == 1 and down == 1:
+        return raw
+    return _resample_data(raw, meg_picks, sfreq, None, up, down, decimate, l_freq, h_freq, n_jobs, n_pad=_filter_pad(h, down))
+
+def _resample_data(raw, meg_picks, sfreq, h, up, down, decimate, l_freq, h_freq, n_jobs, n_pad=None):
+    # Filter (unless h is None) and resample the MEG channels, resample the others like raw.resample()
+    other_picks = np.setdiff1d(np.arange(len(raw.ch_names)), meg_picks)
+    n_out = int(round(raw.n_times * up / down))
+    first_samp = int(round(raw.first_samp * up / down))
+    data = np.empty((len(raw.ch_names), n_out))
+    if len(other_picks):
+        # Channels that are not filtered (ECG, EOG, stim) are resampled the way raw.resample() does it
+        other = mne.io.RawArray(raw.get_data(other_picks), mne.pick_info(raw.info, other_picks), first_samp=raw.first_samp, verbose=False)
+        other.resample(sfreq, method='polyphase')
+        n_out, first_samp = other.n_times, other.first_samp
+        data = np.empty((len(raw.ch_names), n_out))
+        data[other_picks] = other.get_data()
+    _filter_blocks(raw, meg_picks, data, h, up, down, n_out, decimate, n_pad, n_jobs)
+    info = raw.info.copy()
+    with info._unlock():
+        info['sfreq'] = float(sfreq)
+        info['highpass'] = max(info['highpass'], l_freq or 0)
+        info['lowpass'] = min(info['lowpass'], h_freq or info['lowpass'], sfreq / 2.)
+    raw_resampled = mne.io.RawArray(data, info, first_samp=first_samp, verbose=False)
+    raw_resampled.set_annotations(raw.annotations)
+    return raw_resampled
+
+def _filter_blocks(raw, picks, out, h, up, down, n_out, decimate, n_pad, n_jobs):
+    # Filter and resample blocks of 32 channels in parallel into the rows picks of out, n_jobs blocks at a
+    # time, so only those blocks are held in memory on top of the input and output
+    parallel, p_fun, n_jobs = mne.parallel.parallel_func(_fused_filter, n_jobs)
+    blocks = np.array_split(picks, max(len(picks) // 32, 1))
+    for i in range(0, len(blocks), n_jobs):
+        batch = blocks[i:i + n_jobs]
+        for block, block_data in zip(batch, parallel(p_fun(raw.get_data(block), h, up, down, n_out, decimate, n_pad) for block in batch)):
+            out[block] = block_data
+
+def filter_margin(sfreq, l_freq=0.1, h_freq=100, line_freqs=(50,100)):
+    # Half the length (s) of the filter_resample_data filter: how much data on each side of a chunk
+    # the filter needs to give the same output as filtering the whole recording
+    h, up, down, decimate = design_fused_filter(sfreq, l_freq, h_freq, tuple(line_freqs))
+    return (len(h) // 2 + 1) / sfreq
+
+@functools.lru_cache()
+def design_fused_filter(sfreq, l_freq, h_freq, line_freqs, new_sfreq=None):
+    # Combined notch + bandpass FIR filter, plus the up/down factors of the resampler
+    # and whether plain decimation is enough (the lowpass stopband is below the new Nyquist frequency)
+    ratio = Fraction(new_sfreq / sfreq).limit_denominator(1000) if new_sfreq else Fraction(1)
+    up, down = ratio.numerator, ratio.denominator
+    # Bandpass with the same design as raw.filter()
+    h = mne.filter.create_filter(None, sfreq, l_freq, h_freq, fir_design='firwin', verbose=False)
+    if len(line_freqs):
+        # Band-stop filters with the same design as raw.notch_filter() (width freq/200, 1 Hz transition band)
+        line_freqs = np.array(line_freqs, float)
+        widths = line_freqs / 200.
+        h_notch = mne.filter.create_filter(None, sfreq, line_freqs + widths / 2. + 0.5, line_freqs - widths / 2. - 0.5,
+                                           l_trans_bandwidth=0.5, h_trans_bandwidth=0.5, fir_design='firwin', verbose=False)
+        h = np.convolve(h, h_notch)     # Both filters are zero-phase, so the combination is too
+    decimate = False
+    if new_sfreq and h_freq is not None:
+        h_trans = min(max(0.25 * h_freq, 2.), sfreq / 2. - h_freq)     # MNE's 'auto' transition band
+        decimate = up == 1 and h_freq + h_trans <= new_sfreq / 2.
+    return h, up, down, decimate
+
+def _filter_pad(h, down):
+    # Padding on each side for filter h: a multiple of down so the output samples stay aligned
+    return int(np.ceil((len(h) // 2 + 1) / down)) * down
+
+def _fused_filter(data, h, up, down, n_out, decimate=False, n_pad=None):
+    # Zero-phase FIR filtering along the last axis with the edges padded like raw.filter() does,
+    # then resampling. With h None the data are only resampled, padded by n_pad samples
+    if n_pad is None:
+        n_pad = _filter_pad(h, down)
+    padded = np.pad(data, [(0, 0)] * (data.ndim - 1) + [(n_pad, n_pad)], mode='reflect', reflect_type='odd')
+    if h is None:
+        filtered = padded
+    else:
+        filtered = scipy.signal.oaconvolve(padded, h.reshape((1,) * (data.ndim - 1) + (-1,)), mode='same', axes=-1)
+    if decimate:
+        filtered = filtered[..., ::down]    # Already band limited by the lowpass, no need for another filter
+    elif up != 1 or down != 1:
+        filtered = scipy.signal.resample_poly(filtered, up, down, axis=-1)
+    start = n_pad * up // down
+    # A copy, so the decimated output doesn't keep the data at the original rate in memory
+    return np.ascontiguousarray(filtered[..., start:start + n_out])
+
 def fit_ICA(raw, reject, random_state, picks, method = "picard", n_components = 40):
     ica = mne.preprocessing.ICA(n_components=40, method=method, random_state=random_state)
     try:
@@ -0,0 +1,134 @@
+#!/bin/env python
+#
+# Module name: profiling.py
+#
+# Description: Functions to record the wall time, CPU time, peak memory and array sizes of
+#              pipeline stages, written as one JSON profile per subject
+#
+# License: Apache 2.0
+
+import os
+import json
+import time
+import threading
+import contextlib
+import numpy as np
+try:
+    import psutil           # Measures joblib workers (child processes) too
+except ImportError:
+    psutil = None
+
+def _cpu_time():
+    # CPU time (s) of this process and its child processes. Joblib workers are reused between
+    # calls and only count as children once they exit, so running ones are measured with psutil
+    times = os.times()
+    cpu_time = times.user + times.system + times.children_user + times.children_system
+    if psutil is not None:
+        for child in psutil.Process().children(recursive=True):
+            try:
+                child_times = child.cpu_times()
+            except psutil.Error:
+                continue
+            cpu_time += child_times.user + child_times.system
+    return cpu_time
+
+def _read_status(field):
+    # Memory figure (bytes) from /proc/self/status, None where it isn't available
+    try:
+        with open('/proc/self/status') as infile:
+            for line in infile:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def _reset_peak_rss():
+    # Resets the peak RSS of this process (VmHWM) so it can be read per stage (Linux only)
+    try:
+        with open('/proc/self/clear_refs', 'w') as outfile:
+            outfile.write('5')
+        return True
+    except OSError:
+        return False
+
+def _rss():
+    # Resident memory (bytes) of this process and its child processes
+    if psutil is None:
+        return _read_status('VmRSS') or 0
+    process = psutil.Process()
+    rss = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except psutil.Error:
+            continue
+    return rss
+
+def nbytes(obj):
+    # Memory (bytes) held by the arrays in obj: numpy arrays, MNE objects (Raw, source estimates,
+    # covariances, ...) and dicts, lists and tuples of them
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(nbytes(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(nbytes(item) for item in obj)
+    for attribute in ('_data', 'data'):
+        if isinstance(getattr(obj, attribute, None), np.ndarray):
+            return getattr(obj, attribute).nbytes
+    return 0
+
+@contextlib.contextmanager
+def profile(name, records=None, interval=0.05, **fields):
+    # Records how long the body of the with statement takes (wall and CPU time) and the peak
+    # memory of this process plus its workers while it runs, appended to records as a dict with
+    # the stage name and any other fields given. The record is yielded so the body can add to it,
+    # e.g. record['output_bytes'] = profiling.nbytes(result)
+    record = dict(stage=name, **fields)
+    # Memory of the workers can only be sampled, the peak of this process is exact on Linux
+    peak = [_rss()]
+    exact_peak = _reset_peak_rss()
+    done = threading.Event()
+    def sample():
+        while not done.wait(interval):
+            peak[0] = max(peak[0], _rss())
+    sampler = threading.Thread(target=sample, daemon=True)
+    start_rss, start_wall, start_cpu = peak[0], time.perf_counter(), _cpu_time()
+    sampler.start()
+    try:
+        yield record
+    except BaseException:
+        record['failed'] = True
+        raise
+    finally:
+        wall_time, cpu_time = time.perf_counter() - start_wall, _cpu_time() - start_cpu
+        done.set()
+        sampler.join()
+        peak_rss = max(peak[0], _rss())
+        if exact_peak:
+            peak_rss = max(peak_rss, _read_status('VmHWM') or 0)
+        record.update(wall_time=wall_time, cpu_time=cpu_time, start_rss=start_rss, peak_rss=peak_rss)
+        if records is not None:
+            records.append(record)
+
+def profiled(name, records, function):
+    # Wraps function so each call is profiled, also recording the size of the arrays it returns
+    def run(*args, **kwargs):
+        with profile(name, records) as record:
+            result = function(*args, **kwargs)
+            record['output_bytes'] = nbytes(result)
+        return result
+    return run
+
+def write_profile(records, fname, **fields):
+    # Per-subject profile: the stage records plus anything describing the run (subject, cores, ...)
+    with open(fname, 'w') as outfile:
+        json.dump(dict(fields, stages=records), outfile, indent=1)
+    for record in records:
+        print('%-14s %8.1f s  %6.0f%% CPU  %7.2f GB peak' % (record['stage'], record['wall_time'],
+                                                           100 * (record.get('cpu_efficiency') or 0), record['peak_rss'] / 1e9))
+
+def read_profile(fname):
+    with open(fname) as infile:
+        return json.load(infile)
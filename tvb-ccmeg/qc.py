@@ -0,0 +1,181 @@
+#!/bin/env python
+#
+# Module name: qc.py
+#
+# Description: Functions for the pipelines to write compact quality control summaries of each stage
+#              (power spectra of a subsample of channels, averages around artifact events, head
+#              position traces), and script to render them as MNE reports afterwards, for many
+#              subjects at once and outside the pipeline jobs
+#
+# License: Apache 2.0
+
+import mne
+import numpy as np      # Need for array operations
+import scipy.signal
+import json
+import os
+import sys
+import time
+import traceback
+
+# Summaries go to <processed_meg>/<subject>/qc/, listed in order in qc.json
+QC_DIR = 'qc'
+MANIFEST = 'qc.json'
+
+def qc_dir(output_dir):
+    return os.path.join(output_dir, QC_DIR)
+
+def _add_entry(output_dir, entry):
+    # Add (or replace, on a rerun) an entry of the subject's list of summaries
+    os.makedirs(qc_dir(output_dir), exist_ok=True)
+    fname = os.path.join(qc_dir(output_dir), MANIFEST)
+    entries = []
+    if os.path.isfile(fname):
+        with open(fname) as infile:
+            entries = json.load(infile)
+    names = [old['name'] for old in entries]
+    if entry['name'] in names:
+        entries[names.index(entry['name'])] = entry
+    else:
+        entries.append(entry)
+    with open(fname, 'w') as outfile:
+        json.dump(entries, outfile, indent=1)
+
+def read_manifest(output_dir):
+    with open(os.path.join(qc_dir(output_dir), MANIFEST)) as infile:
+        return json.load(infile)
+
+def pick_subsample(info, n_per_type=32):
+    # Up to n_per_type good channels of each data channel type, spread evenly over the array
+    picks = []
+    for ch_type in ('mag', 'grad', 'eeg'):
+        if ch_type not in info.get_channel_types(unique=True):
+            continue
+        type_picks = mne.pick_types(info, meg=ch_type if ch_type != 'eeg' else False, eeg=ch_type == 'eeg', exclude='bads')
+        if len(type_picks) > n_per_type:
+            type_picks = type_picks[np.linspace(0, len(type_picks) - 1, n_per_type).round().astype(int)]
+        picks += list(type_picks)
+    return np.array(picks, dtype=int)
+
+def write_psd(output_dir, name, title, raw, n_per_type=32, fmax=350., resolution=0.5, max_duration=120.):
+    # Welch power spectrum (resolution Hz) of a subsample of channels, from max_duration s of data
+    # spread over the recording, saved as float32 with the channel names and types
+    picks = pick_subsample(raw.info, n_per_type)
+    sfreq = raw.info['sfreq']
+    n_fft = min(int(2 ** np.ceil(np.log2(sfreq / resolution))), raw.n_times)
+    # Evenly spaced segments covering max_duration s in total, read one at a time
+    n_segments = int(min(max_duration * sfreq, raw.n_times) // n_fft)
+    starts = np.linspace(0, raw.n_times - n_fft, max(n_segments, 1)).astype(int)
+    freqs, psd = None, 0.
+    for start in starts:
+        data = raw.get_data(picks, start, start + n_fft)
+        freqs, segment_psd = scipy.signal.welch(data, sfreq, nperseg=min(n_fft, data.shape[1]))
+        psd = psd + segment_psd / len(starts)
+    keep = freqs <= min(fmax, sfreq / 2.)
+    fname = os.path.join(qc_dir(output_dir), name + '_psd.npz')
+    os.makedirs(qc_dir(output_dir), exist_ok=True)
+    np.savez(fname, freqs=freqs[keep], psd=psd[:, keep].astype(np.float32), ch_names=np.array([raw.ch_names[pick] for pick in picks]),
+             ch_types=np.array(raw.get_channel_types(picks=picks)))
+    _add_entry(output_dir, dict(name=name, title=title, kind='psd', fname=os.path.basename(fname),
+                                info=dict(sfreq=float(sfreq), n_times=int(raw.n_times), duration=float(raw.n_times / sfreq), n_channels=len(raw.ch_names),
+                                          bads=list(raw.info['bads']), n_projs=len(raw.info['projs']))))
+
+def write_evokeds(output_dir, name, title, evokeds):
+    # Averages (e.g. around heartbeats before and after correction), titles -> mne.Evoked
+    # One file each, as the averages after correction carry projectors the others don't
+    os.makedirs(qc_dir(output_dir), exist_ok=True)
+    fnames = []
+    for k, (comment, evoked) in enumerate(evokeds.items()):
+        evoked.comment = comment
+        fnames.append(name + '_%d-ave.fif' % k)
+        evoked.save(os.path.join(qc_dir(output_dir), fnames[-1]), overwrite=True, verbose=False)
+    _add_entry(output_dir, dict(name=name, title=title, kind='evokeds', fnames=fnames))
+
+def write_artifact_evokeds(output_dir, artifact_evokeds):
+    # Averages of preprocess.add_ecg_eog_projectors / compute_artifact_evokeds, one entry per artifact
+    for mode, (before, after) in artifact_evokeds.items():
+        write_evokeds(output_dir, mode.lower(), mode, {mode + ' Before': before, mode + ' After': after})
+
+def write_head_pos(output_dir, name, title, head_pos):
+    fname = os.path.join(qc_dir(output_dir), name + '.pos')
+    os.makedirs(qc_dir(output_dir), exist_ok=True)
+    mne.chpi.write_head_pos(fname, head_pos)
+    _add_entry(output_dir, dict(name=name, title=title, kind='head_pos', fname=os.path.basename(fname)))
+
+def plot_psd(fname, title):
+    # Spectrum of each channel of the subsample, one panel per channel type
+    import matplotlib.pyplot as plt
+    summary = np.load(fname)
+    ch_types = list(dict.fromkeys(summary['ch_types']))
+    units = dict(mag=('fT', 1e15), grad=('fT/cm', 1e13), eeg=('µV', 1e6))
+    fig, axes = plt.subplots(len(ch_types), 1, figsize=(8, 3 * len(ch_types)), squeeze=False)
+    for ax, ch_type in zip(axes[:, 0], ch_types):
+        unit, scale = units[ch_type]
+        psd = summary['psd'][summary['ch_types'] == ch_type] * scale**2
+        ax.semilogy(summary['freqs'], psd.T, color='k', alpha=0.2, linewidth=0.5)
+        ax.semilogy(summary['freqs'], np.median(psd, axis=0), color='C0', linewidth=1.5)
+        ax.set(title=ch_type + ' (' + str(len(psd)) + ' channels)', ylabel=unit + '²/Hz')
+    axes[-1, 0].set_xlabel('Frequency (Hz)')
+    fig.suptitle(title)
+    fig.tight_layout()
+    return fig
+
+def render_report(output_dir, subject):
+    # MNE report of the summaries written by a pipeline run, saved as report.html in the output directory
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    report = mne.Report(title=subject + '_QC_report', verbose=False)
+    for entry in read_manifest(output_dir):
+        fname = os.path.join(qc_dir(output_dir), entry.get('fname', ''))
+        if entry['kind'] == 'psd':
+            info = entry['info']
+            report.add_html('<p>' + ', '.join(key + ': ' + str(value) for key, value in info.items()) + '</p>',
+                            title=entry['title'] + ' info', section=entry['title'])
+            fig = plot_psd(fname, entry['title'])
+            report.add_figure(fig=fig, title=entry['title'] + ' PSD', section=entry['title'])
+            plt.close(fig)
+        elif entry['kind'] == 'evokeds':
+            evokeds = [mne.read_evokeds(os.path.join(qc_dir(output_dir), evoked_fname), condition=0, verbose=False) for evoked_fname in entry['fnames']]
+            report.add_evokeds(evokeds=evokeds, titles=[evoked.comment for evoked in evokeds])
+        elif entry['kind'] == 'head_pos':
+            fig = mne.viz.plot_head_positions(mne.chpi.read_head_pos(fname), mode='traces', show=False)
+            report.add_figure(fig=fig, title=entry['title'])
+            plt.close(fig)
+    report.save(os.path.join(output_dir, 'report.html'), overwrite=True, open_browser=False, verbose=False)
+
+def _render_subject(processed_dir, subject):
+    # Runs in a worker process, errors are returned so one bad subject doesn't stop the others
+    start = time.perf_counter()
+    try:
+        render_report(os.path.join(processed_dir, subject), subject)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return error, time.perf_counter() - start
+
+if __name__ == '__main__':
+    if len(sys.argv) <= 2:
+        raise ValueError("A processed data directory and a subject list have not been provided. Usage:"
+                         "\n\tpython qc.py <processed_meg_dir> <subject_list.txt> [<n_workers>]")
+    import multiprocessing
+    import run_batch    # Subject lists and sharing the cores between worker processes
+    import scheduler    # Module with functions to share the cores between parallel jobs and BLAS threads
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    processed_dir = sys.argv[1]
+    subjects = run_batch.read_subject_list(sys.argv[2])
+    n_workers, worker_cpu = run_batch.split_cores(scheduler.available_cpus(), int(sys.argv[3]) if len(sys.argv) > 3 else 1)
+    for variable in run_batch.THREAD_VARIABLES:
+        os.environ[variable] = str(worker_cpu)
+    failed = []
+    with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(_render_subject, processed_dir, subject): subject for subject in subjects}
+        for future in as_completed(futures):
+            error, run_time = future.result()
+            print(futures[future] + (' failed' if error else ' finished') + ' in ' + str(round(run_time)) + ' s\n' + (error or ''))
+            if error:
+                failed.append(futures[future])
+    print(str(len(subjects) - len(failed)) + ' of ' + str(len(subjects)) + ' reports rendered')
+    if failed:
+        print('Failed subjects:\n' + '\n'.join(failed))
+        sys.exit(1)
@@ -0,0 +1,133 @@
+#!/bin/env python
+#
+# Module name: run_batch.py
+#
+# Description: Script to process a list of subjects in one job, several at a time in a pool of
+#              worker processes, so the container start, FreeSurfer setup and imports are paid
+#              once per node rather than once per subject
+#
+# License: Apache 2.0
+
+import os
+import sys
+import time
+import traceback
+import importlib
+import multiprocessing
+import scheduler        # Module with functions to share the cores between parallel jobs and BLAS threads
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+PIPELINES = {'beamformer': 'pipeline_rest_beamformer', 'mne': 'pipeline_rest_mne'}
+
+# Environment variables that set the number of threads of the linear algebra libraries
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+
+def read_subject_list(fname):
+    # One subject per line, blank lines and lines starting with # are skipped
+    with open(fname) as infile:
+        subjects = [line.strip() for line in infile]
+    return [subject for subject in subjects if subject and not subject.startswith('#')]
+
+def split_cores(n_cpu, n_workers):
+    # Each worker gets an equal share of the cores, which its stages use either as joblib jobs or
+    # as BLAS threads (see scheduler.py)
+    n_workers = max(min(n_workers, n_cpu), 1)
+    return n_workers, max(n_cpu // n_workers, 1)
+
+def _run_subject(pipeline, subject, n_cpu, running):
+    # Runs in a worker process: any exception is caught and returned so one bad subject
+    # doesn't stop the others
+    running[subject] = os.getpid()
+    start = time.perf_counter()
+    try:
+        importlib.import_module(PIPELINES[pipeline]).run_subject(subject, n_cpu=n_cpu)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        del running[subject]
+    return error, time.perf_counter() - start
+
+def _run_pool(context, pipeline, subjects, n_workers, n_cpu, running, errors):
+    # Process subjects in one pool of n_workers processes, storing the outcome of each in errors
+    # Returns the subjects lost because a worker process died, which takes down the whole pool
+    broken = []
+    with ProcessPoolExecutor(n_workers, mp_context=context) as executor:
+        futures = {executor.submit(_run_subject, pipeline, subject, n_cpu, running): subject for subject in subjects}
+        for future in as_completed(futures):
+            subject = futures[future]
+            try:
+                error, run_time = future.result()
+            except BrokenProcessPool:
+                broken.append(subject)
+                continue
+            errors[subject] = error
+            print(subject + (' failed' if error else ' finished') + ' in ' + str(round(run_time)) + ' s\n' + (error or ''))
+    return broken
+
+def run_batch(pipeline, subjects, n_workers, n_cpu=None, max_restarts=3):
+    # Process the subjects n_workers at a time, returns a dict of subject -> error message (None if it succeeded)
+    # max_restarts: how many times the pool is rebuilt after a worker died without any subject to blame
+    # (e.g. while starting up), before the subjects left are given up as failed
+    if n_cpu is None:
+        n_cpu = scheduler.available_cpus()
+    n_workers, worker_cpu = split_cores(n_cpu, n_workers)
+    # Set the BLAS threads before the workers start, so numpy picks them up when it is imported
+    # (without threadpoolctl this is the only way to keep the workers from using the whole node)
+    for variable in THREAD_VARIABLES:
+        os.environ[variable] = str(worker_cpu)
+    print('Processing ' + str(len(subjects)) + ' subjects, ' + str(n_workers) + ' at a time with ' + str(worker_cpu) + ' cores each\n')
+    context = multiprocessing.get_context('spawn')   # Fresh interpreters, no state copied from this process
+    errors = dict()
+    with context.Manager() as manager:
+        running = manager.dict()    # Subjects being processed, to know which ones were hit when a worker dies
+        pending, suspects = list(subjects), []
+        breaks = dict()             # Number of times the pool broke while each subject was running
+        restarts = 0
+        while pending:
+            broken = _run_pool(context, pipeline, pending, n_workers, worker_cpu, running, errors)
+            # If a worker process died (e.g. killed for running out of memory), one of the subjects that were
+            # running is to blame. It is only known if it was the only one: it is retried on its own at the end.
+            # Otherwise they all go back in a new pool with the ones that had not started, and only a subject
+            # that was running when the pool broke a second time is retried on its own
+            hit = [subject for subject in broken if subject in running]
+            pending = [subject for subject in broken if subject not in running]
+            for subject in hit:
+                breaks[subject] = breaks.get(subject, 0) + 1
+                if len(hit) == 1 or breaks[subject] > 1:
+                    suspects.append(subject)
+                else:
+                    pending.append(subject)
+            if broken and not hit:
+                # A worker died before it recorded its subject, so nothing can be blamed and the next pool
+                # may fail the same way
+                restarts += 1
+                if restarts > max_restarts:
+                    for subject in pending:
+                        errors[subject] = 'Worker processes kept dying before processing this subject'
+                        print(subject + ' failed: ' + errors[subject] + '\n')
+                    pending = []
+            running.clear()
+        for subject in suspects:
+            if _run_pool(context, pipeline, [subject], 1, worker_cpu, running, errors):
+                errors[subject] = 'Worker process died while processing this subject'
+                print(subject + ' failed: ' + errors[subject] + '\n')
+            running.clear()
+    return errors
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in PIPELINES:
+        raise ValueError("A pipeline and a subject list have not been provided. Usage:"
+                         "\n\tpython run_batch.py <beamformer|mne> <subject_list.txt> [<n_workers>]")
+    pipeline = sys.argv[1]
+    subjects = read_subject_list(sys.argv[2])
+    n_workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+
+    errors = run_batch(pipeline, subjects, n_workers)
+
+    failed = [subject for subject in subjects if errors.get(subject)]
+    print(str(len(subjects) - len(failed)) + ' of ' + str(len(subjects)) + ' subjects processed')
+    if failed:
+        print('Failed subjects:\n' + '\n'.join(failed))
+        sys.exit(1)
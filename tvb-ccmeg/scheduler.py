@@ -0,0 +1,94 @@
+#!/bin/env python
+#
+# Module name: scheduler.py
+#
+# Description: Functions to divide the cores allocated to a job between joblib workers and
+#              BLAS threads stage by stage, and to record how well each stage used them
+#
+# License: Apache 2.0
+
+import os
+import contextlib
+import profiling        # Module with functions to record the time and memory used by each stage
+try:
+    import threadpoolctl    # Changes the number of BLAS threads after numpy has been imported
+except ImportError:
+    threadpoolctl = None
+try:
+    import joblib           # Sets the BLAS threads of the workers started by MNE's parallel functions
+except ImportError:
+    joblib = None           # MNE then runs everything in this process
+
+# How each stage runs in parallel:
+#   'jobs' - splits into independent pieces (channels, windows, chunks, sources), run by n_jobs
+#            joblib workers with one BLAS thread each
+#   'blas' - dominated by large matrix products and decompositions, run in this process by
+#            multithreaded BLAS
+STAGE_KINDS = {
+    'head_pos': 'jobs',     # Windows of the recording
+    'filter': 'jobs',       # Blocks of channels
+    'data_cov': 'jobs',     # Chunks of the recording
+    'noise_cov': 'jobs',
+    'src': 'jobs',          # Surface patches
+    'fwd': 'jobs',          # Sources
+    'sss': 'blas',          # Maxwell filter: projection of each buffer onto the SSS basis
+    'ica': 'blas',
+    'artifacts': 'blas',
+    'bem': 'blas',
+    'lcmv': 'blas',
+    'inv': 'blas',
+    'apply': 'blas',        # Applying the beamformer / inverse operator
+    'parcellation': 'blas',
+    'qc': 'blas',           # Quality control summaries (spectra of a subsample of channels)
+}
+
+def available_cpus():
+    # Cores allocated by SLURM, or the cores this process may run on outside SLURM
+    if os.environ.get('SLURM_CPUS_PER_TASK'):
+        return int(os.environ['SLURM_CPUS_PER_TASK'])
+    return len(os.sched_getaffinity(0))
+
+def stage_resources(kind, n_cpu):
+    # (joblib n_jobs, BLAS threads in this process) for a kind of stage
+    if kind == 'jobs':
+        # The workers are limited to one BLAS thread each by stage(): loky only does it by itself when
+        # OMP_NUM_THREADS is not set, which run_batch.py sets for its own workers
+        return n_cpu, 1
+    return 1, n_cpu
+
+@contextlib.contextmanager
+def stage(name, n_cpu, records=None, kind=None):
+    # Runs the body of the with statement with the BLAS threads set for the stage and gives the
+    # number of joblib jobs to use, e.g.
+    #     with scheduler.stage('fwd', n_cpu, records) as n_jobs:
+    #         fwd = mne.make_forward_solution(..., n_jobs=n_jobs)
+    # The stage is profiled (see profiling.profile) and its CPU efficiency, CPU time / (wall time x cores),
+    # is added to the record appended to records
+    kind = kind or STAGE_KINDS[name]
+    n_jobs, n_threads = stage_resources(kind, n_cpu)
+    if threadpoolctl is not None:
+        limits = threadpoolctl.threadpool_limits(limits=n_threads)
+    else:
+        limits = contextlib.nullcontext()   # Falls back on OMP_NUM_THREADS as set when numpy was imported
+    if kind == 'jobs' and joblib is not None:
+        # One BLAS thread per joblib worker, whatever the thread variables inherited from this process
+        workers = joblib.parallel_config(backend='loky', inner_max_num_threads=1)
+    else:
+        workers = contextlib.nullcontext()
+    with limits, workers, profiling.profile(name, records, kind=kind, n_cpu=n_cpu, n_jobs=n_jobs, blas_threads=n_threads,
+                                            cpu_efficiency=None) as record:
+        yield n_jobs
+    if record['wall_time'] > 0:
+        record['cpu_efficiency'] = record['cpu_time'] / (record['wall_time'] * n_cpu)
+
+def staged(name, n_cpu, records, compute):
+    # Wraps compute(n_jobs) as a function without arguments that runs it as a stage, e.g. for
+    # stage_cache.run_stage(..., scheduler.staged('fwd', n_cpu, records, lambda n_jobs: ...))
+    # Also records the size of the arrays it returns
+    def run():
+        with stage(name, n_cpu, records) as n_jobs:
+            result = compute(n_jobs)
+        if records:
+            records[-1]['output_bytes'] = profiling.nbytes(result)
+        return result
+    return run
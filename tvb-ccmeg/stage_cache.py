@@ -0,0 +1,201 @@
+#!/bin/env python
+#
+# Module name: stage_cache.py
+#
+# Description: Content-addressed cache for pipeline stages so interrupted
+#              SLURM jobs can resume from the last valid artifact, and so
+#              concurrent jobs can share artifacts (e.g. empty room covariances)
+#
+# License: Apache 2.0
+
+import mne
+import os
+import numpy as np
+import scipy.sparse
+import json
+import copy
+import hashlib
+import fcntl
+import contextlib
+
+# Keys are chained: each stage hashes its own inputs and parameters together
+# with the keys of the stages it depends on, so changing one parameter only
+# invalidates the stages downstream of it.
+
+_file_digests = {}  # Hashing a large FIF file takes a few seconds, only do it once per process
+
+def file_digest(fname, block_size=2**20):
+    # SHA-256 of the file contents (not the path, so identical files share cache entries)
+    fname = os.path.abspath(fname)
+    stat = os.stat(fname)
+    memo_key = (fname, stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_digests:
+        sha = hashlib.sha256()
+        with open(fname, 'rb') as infile:
+            for block in iter(lambda: infile.read(block_size), b''):
+                sha.update(block)
+        _file_digests[memo_key] = sha.hexdigest()
+    return _file_digests[memo_key]
+
+def stage_key(name, inputs=(), params=None, parents=()):
+    # inputs: files the stage reads, params: anything that changes its output,
+    # parents: keys of the stages whose output it uses
+    description = dict(name=name,
+                       inputs=[file_digest(fname) for fname in inputs],
+                       params=params or {},
+                       parents=list(parents),
+                       mne=mne.__version__)
+    encoded = json.dumps(description, sort_keys=True, default=repr)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+def fingerprint(*objs):
+    # SHA-256 of in-memory objects (arrays, dicts and lists of them, e.g. projectors or ICA matrices),
+    # for stages whose output depends on something computed earlier rather than on a file
+    sha = hashlib.sha256()
+    def update(obj):
+        if isinstance(obj, np.ndarray):
+            sha.update(repr((obj.dtype.str, obj.shape)).encode())
+            sha.update(np.ascontiguousarray(obj).tobytes())
+        elif isinstance(obj, dict):
+            for key in sorted(obj, key=repr):
+                sha.update(repr(key).encode())
+                update(obj[key])
+        elif isinstance(obj, (list, tuple)):
+            sha.update(b'[' + str(len(obj)).encode())
+            for item in obj:
+                update(item)
+        else:
+            sha.update(repr(obj).encode())
+    for obj in objs:
+        update(obj)
+    return sha.hexdigest()
+
+def _save_parc_index(fname, index):
+    # Sparse (n_labels, n_sources) matrix plus the label names of each parcellation, rows in order
+    matrix = index['matrix']
+    atlases = [atlas for atlas, names in index['labels'].items() for name in names]
+    names = [name for names in index['labels'].values() for name in names]
+    np.savez(fname, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr, shape=matrix.shape,
+             atlases=np.array(atlases), names=np.array(names))
+
+def _load_parc_index(fname):
+    with np.load(fname) as npz:
+        matrix = scipy.sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape=tuple(npz['shape']))
+        labels = dict()
+        for atlas, name in zip(npz['atlases'].tolist(), npz['names'].tolist()):
+            labels.setdefault(atlas, []).append(name)
+    return dict(matrix=matrix, labels=labels)
+
+def _save_evokeds(fname, evokeds):
+    # Averages around the artifacts, mode -> (before, after correction), as returned by
+    # preprocess.add_ecg_eog_projectors. Only the averages before correction are written, with the
+    # projectors in their info but not applied, the ones after correction are rebuilt by applying them
+    if not evokeds:
+        # No events at all: a file with only a measurement info, which reads back as no averages
+        mne.io.write_info(fname, mne.create_info(['none'], 1.))
+        return
+    saved = []
+    for mode, (before, after) in evokeds.items():
+        evoked = before.copy()
+        projs = [copy.deepcopy(proj) for proj in after.info['projs']]
+        for proj in projs:
+            proj['active'] = False
+        evoked.add_proj(projs)
+        evoked.comment = mode
+        saved.append(evoked)
+    mne.write_evokeds(fname, saved, overwrite=True, verbose=False)
+
+def _load_evokeds(fname):
+    evokeds = dict()
+    for evoked in mne.read_evokeds(fname, proj=False, verbose=False):
+        after = evoked.copy().apply_proj()
+        evokeds[evoked.comment] = (evoked.del_proj(), after)
+    return evokeds
+
+# How to write and read back each kind of artifact (file suffix, save, load)
+# Suffixes follow MNE naming conventions so MNE does not warn on save
+_ARTIFACT_IO = {
+    'raw': ('-raw.fif',
+            lambda fname, raw: raw.save(fname, overwrite=True),
+            lambda fname: mne.io.read_raw_fif(fname, preload=True)),
+    'cov': ('-cov.fif',
+            lambda fname, cov: mne.write_cov(fname, cov, overwrite=True),
+            lambda fname: mne.read_cov(fname)),
+    'ica': ('-ica.fif',
+            lambda fname, ica: ica.save(fname, overwrite=True),
+            lambda fname: mne.preprocessing.read_ica(fname)),
+    'head_pos': ('.pos',
+                 lambda fname, head_pos: mne.chpi.write_head_pos(fname, head_pos),
+                 lambda fname: mne.chpi.read_head_pos(fname)),
+    'bem': ('-bem-sol.fif',
+            lambda fname, bem: mne.write_bem_solution(fname, bem, overwrite=True),
+            lambda fname: mne.read_bem_solution(fname)),
+    'src': ('-src.fif',
+            lambda fname, src: mne.write_source_spaces(fname, src, overwrite=True),
+            lambda fname: mne.read_source_spaces(fname)),
+    'fwd': ('-fwd.fif',
+            lambda fname, fwd: mne.write_forward_solution(fname, fwd, overwrite=True),
+            lambda fname: mne.read_forward_solution(fname)),
+    'inv': ('-inv.fif',
+            lambda fname, inv: mne.minimum_norm.write_inverse_operator(fname, inv, overwrite=True),
+            lambda fname: mne.minimum_norm.read_inverse_operator(fname)),
+    'lcmv': ('-lcmv.h5',
+             lambda fname, filters: filters.save(fname, overwrite=True),
+             lambda fname: mne.beamformer.read_beamformer(fname)),
+    'parc_index': ('-parc.npz', _save_parc_index, _load_parc_index),
+    'evokeds': ('-ave.fif', _save_evokeds, _load_evokeds),
+}
+
+def artifact_fname(cache_dir, name, key, kind):
+    suffix = _ARTIFACT_IO[kind][0]
+    return os.path.join(cache_dir, name + '_' + key[:16] + suffix)
+
+def _manifest_fname(cache_dir, name, key):
+    return os.path.join(cache_dir, name + '_' + key[:16] + '.json')
+
+@contextlib.contextmanager
+def _locked(cache_dir, name, key):
+    # Exclusive lock on one artifact, so two jobs sharing a cache directory never compute or write
+    # the same artifact at once (POSIX locks, which also work on NFS and Lustre mounted with flock)
+    with open(os.path.join(cache_dir, name + '_' + key[:16] + '.lock'), 'a') as lock_file:
+        fcntl.lockf(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+def is_cached(cache_dir, name, key):
+    # An artifact only counts once its manifest exists, the manifest is written last
+    manifest_fname = _manifest_fname(cache_dir, name, key)
+    if not os.path.isfile(manifest_fname):
+        return False
+    with open(manifest_fname) as infile:
+        manifest = json.load(infile)
+    return manifest['key'] == key and os.path.isfile(os.path.join(cache_dir, manifest['fname']))
+
+def run_stage(cache_dir, name, key, kind, compute):
+    # Load the artifact for this key if a previous run finished it, otherwise
+    # compute it and write it to the cache before returning it
+    os.makedirs(cache_dir, exist_ok=True)
+    fname = artifact_fname(cache_dir, name, key, kind)
+    suffix, save, load = _ARTIFACT_IO[kind]
+    if is_cached(cache_dir, name, key):
+        print('Loading cached ' + name + ' from ' + fname)
+        return load(fname)
+    with _locked(cache_dir, name, key):
+        # Another job may have finished it while we were waiting for the lock
+        if is_cached(cache_dir, name, key):
+            print('Loading cached ' + name + ' from ' + fname)
+            return load(fname)
+        result = compute()
+        # Write to a temporary file then rename, so a job killed mid-write never
+        # leaves a truncated artifact that looks valid (and readers never see a partial file)
+        tmp_fname = os.path.join(cache_dir, '.tmp' + str(os.getpid()) + '_' + os.path.basename(fname))
+        save(tmp_fname, result)
+        os.replace(tmp_fname, fname)
+        manifest_fname = _manifest_fname(cache_dir, name, key)
+        tmp_fname = os.path.join(cache_dir, '.tmp' + str(os.getpid()) + '_' + os.path.basename(manifest_fname))
+        with open(tmp_fname, 'w') as outfile:
+            json.dump(dict(name=name, key=key, kind=kind, fname=os.path.basename(fname)), outfile)
+        os.replace(tmp_fname, manifest_fname)
+    return result
@@ -0,0 +1,158 @@
+#!/bin/env python
+#
+# Module name: synthetic.py
+#
+# Description: Functions to build synthetic Cam-CAN-like inputs offline (Vectorview recordings with
+#              ECG/EOG channels, FreeSurfer-like subjects with surfaces, BEM, parcellations and a
+#              segmentation) so the pipeline functions can be benchmarked without real data
+#
+# License: Apache 2.0
+
+import mne              # Need MNE Python
+import numpy as np      # Need for array operations
+import scipy.spatial
+import os
+from mne.io.constants import FIFF
+
+calibration = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sss_params/sss_cal.dat')
+cross_talk = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sss_params/ct_sparse.fif')
+
+# Head shape: sphere fitted to the digitized points (head coordinates, m)
+head_origin = np.array([0., 0., 0.04])
+head_radius = 0.09
+# Device to head transform placing the head inside the helmet (centre of the sensor array at
+# about (0, 0.015, -0.011) m in device coordinates)
+dev_head_t = mne.transforms.Transform('meg', 'head', mne.transforms.translation(0., -0.015, 0.051))
+hpi_freqs = (293., 307., 314., 321.)   # Cam-CAN cHPI coil frequencies (Hz)
+
+def make_info(sfreq=1000., chpi=False):
+    # Vectorview channels (names and sensor positions from the fine calibration file) plus EOG and
+    # ECG channels, head digitization and optionally the cHPI coil set-up
+    cal = mne.preprocessing.read_fine_calibration(calibration)
+    ch_types = ['mag' if name.endswith('1') else 'grad' for name in cal['ch_names']]
+    info = mne.create_info(cal['ch_names'] + ['EOG061', 'EOG062', 'ECG063'], sfreq, ch_types + ['eog', 'eog', 'ecg'])
+    for ch, loc, ch_type in zip(info['chs'], cal['locs'], ch_types):
+        ch['loc'][:] = loc
+        ch['coil_type'] = FIFF.FIFFV_COIL_VV_MAG_T3 if ch_type == 'mag' else FIFF.FIFFV_COIL_VV_PLANAR_T1
+    # Fiducials and head shape points on the upper half of the head sphere
+    rng = np.random.RandomState(0)
+    points = rng.randn(100, 3)
+    points[:, 2] = np.abs(points[:, 2])
+    points = head_origin + head_radius * points / np.linalg.norm(points, axis=1, keepdims=True)
+    hpi = head_origin + np.array([[0.06, 0.05, 0.03], [-0.06, 0.05, 0.03], [0.05, -0.05, 0.05], [-0.05, -0.05, 0.05]])
+    montage = mne.channels.make_dig_montage(nasion=[0., 0.1, 0.], lpa=[-0.08, 0., 0.], rpa=[0.08, 0., 0.],
+                                            hsp=points, hpi=hpi, coord_frame='head')
+    info.set_montage(montage)
+    with info._unlock():
+        info['dev_head_t'] = dev_head_t.copy()
+        if chpi:
+            info['hpi_meas'] = [dict(hpi_coils=[dict(number=k + 1, coil_freq=freq) for k, freq in enumerate(hpi_freqs)])]
+            info['hpi_results'] = [dict(dig_points=[dict(kind=FIFF.FIFFV_POINT_HPI, ident=k + 1, r=r, coord_frame=FIFF.FIFFV_COORD_UNKNOWN)
+                                                    for k, r in enumerate(hpi)],
+                                        order=np.arange(1, 5), used=np.arange(1, 5), dist_limit=0.005, good_limit=0.98,
+                                        goodness=np.ones(4), coord_trans=dev_head_t.copy())]
+    return info
+
+def make_raw(duration=60., sfreq=1000., picks=None, chpi=False, seed=0):
+    # Resting-state-like recording: sensor noise, correlated brain rhythms (1/f plus alpha),
+    # power line noise, heartbeats and blinks with their own MEG topographies, and optionally cHPI
+    info = make_info(sfreq, chpi=chpi)
+    rng = np.random.RandomState(seed)
+    n_times = int(round(duration * sfreq))
+    times = np.arange(n_times) / sfreq
+    meg = mne.pick_types(info, meg=True)
+    grad = mne.pick_types(info, meg='grad')
+    mag = mne.pick_types(info, meg='mag')
+    data = np.zeros((len(info['ch_names']), n_times))
+    # 20 pink noise sources with an alpha peak, mixed into the MEG channels
+    spectrum = rng.randn(20, n_times // 2 + 1) + 1j * rng.randn(20, n_times // 2 + 1)
+    freqs = np.fft.rfftfreq(n_times, 1. / sfreq)
+    spectrum *= 1. / np.sqrt(np.maximum(freqs, 1.)) + 3. * np.exp(-(freqs - 10.)**2 / 2.)
+    sources = np.fft.irfft(spectrum, n_times)
+    sources /= sources.std(axis=1, keepdims=True)
+    brain = rng.randn(len(meg), 20) @ sources
+    # Heartbeats (~75 bpm) and blinks (every ~4 s)
+    ecg = np.zeros(n_times)
+    ecg[np.arange(int(0.4 * sfreq), n_times, int(0.8 * sfreq))] = 1.
+    ecg = np.convolve(ecg, np.hanning(int(0.04 * sfreq)), 'same')
+    eog = np.zeros(n_times)
+    eog[np.arange(int(2. * sfreq), n_times, int(4. * sfreq))] = 1.
+    eog = np.convolve(eog, np.hanning(int(0.2 * sfreq)), 'same')
+    data[meg] = (brain + 10. * np.outer(rng.randn(len(meg)), ecg) + 30. * np.outer(rng.randn(len(meg)), eog)
+                 + 2. * np.sin(2 * np.pi * 50. * times) + rng.randn(len(meg), n_times))
+    data[grad] *= 1e-12     # T/m
+    data[mag] *= 2e-14      # T
+    data[mne.pick_types(info, meg=False, eog=True)] = 3e-4 * eog + 1e-5 * rng.randn(2, n_times)
+    data[mne.pick_types(info, meg=False, ecg=True)] = 1e-3 * ecg + 2e-5 * rng.randn(n_times)
+    raw = mne.io.RawArray(data, info, verbose=False)
+    if chpi:
+        raw = mne.simulation.add_chpi(raw, verbose=False)
+    if picks is not None:
+        raw.pick(picks)
+    return raw
+
+def _sphere_surface(grade):
+    # Unit icosahedral sphere (the BEM code needs an icosahedral subdivision)
+    from mne.surface import _get_ico_surface
+    surf = _get_ico_surface(grade)
+    return surf['rr'], surf['tris']
+
+def _write_annotation(subject, subjects_dir, parc, sphere, n_labels, seed):
+    # Random Voronoi parcellation of the sphere with n_labels regions per hemisphere
+    rng = np.random.RandomState(seed)
+    labels = []
+    for hemi in ('lh', 'rh'):
+        centres = rng.randn(n_labels, 3)
+        centres /= np.linalg.norm(centres, axis=1, keepdims=True)
+        region = np.argmax(sphere @ centres.T, axis=1)
+        for k in np.unique(region):
+            labels.append(mne.Label(np.flatnonzero(region == k), hemi=hemi, name=parc + '_%03d-%s' % (k, hemi), subject=subject))
+    mne.write_labels_to_annot(labels, subject, parc, subjects_dir=subjects_dir, overwrite=True, verbose=False)
+
+def make_subject(subjects_dir, subject='synthetic', parcellations=None, grade=5):
+    # FreeSurfer-like subject: folded ellipsoid white/orig surfaces for each hemisphere with their
+    # spheres, a spherical inner skull surface for the BEM, annotations for each parcellation
+    # (annotation name: number of labels per hemisphere) and an aparc+aseg-like segmentation
+    # Coordinates are surface RAS, with the MRI aligned to the head frame (identity trans)
+    import nibabel as nib   # Needed to write FreeSurfer surfaces and volumes
+    if parcellations is None:
+        parcellations = {'aparc': 34, 'Schaefer2018_200Parcels_17Networks_order': 100}
+    for dname in ('surf', 'label', 'bem', 'mri'):
+        os.makedirs(os.path.join(subjects_dir, subject, dname), exist_ok=True)
+    sphere, tris = _sphere_surface(grade)
+    folding = 1. + 0.08 * np.sin(7 * sphere[:, 0]) * np.cos(6 * sphere[:, 1]) * np.sin(5 * sphere[:, 2])
+    for hemi, side in (('lh', -1), ('rh', 1)):
+        surface = sphere * folding[:, np.newaxis] * [28., 50., 38.] + [side * 32., 0., 40.]
+        for surf in ('white', 'orig'):
+            nib.freesurfer.write_geometry(os.path.join(subjects_dir, subject, 'surf', hemi + '.' + surf), surface, tris)
+        nib.freesurfer.write_geometry(os.path.join(subjects_dir, subject, 'surf', hemi + '.sphere'), 100. * sphere, tris)
+    skull, skull_tris = _sphere_surface(4)
+    nib.freesurfer.write_geometry(os.path.join(subjects_dir, subject, 'bem', 'inner_skull.surf'),
+                                  1000. * head_origin + 0.95 * 1000. * head_radius * skull, skull_tris)
+    for k, (parc, n_labels) in enumerate(parcellations.items()):
+        _write_annotation(subject, subjects_dir, parc, sphere, n_labels, seed=k)
+    # Segmentation: cortical aparc labels (1001-1035 left, 2001-2035 right) in a 4 mm volume,
+    # split into the same kind of Voronoi regions
+    shape, voxel_size = (64, 64, 64), 4.
+    vox2ras = _tkr_vox2ras(shape, voxel_size)
+    ras = mne.transforms.apply_trans(vox2ras, np.indices(shape).reshape(3, -1).T)
+    rng = np.random.RandomState(len(parcellations))
+    centres = 1000. * head_origin + 60. * rng.uniform(-1, 1, (35, 3))
+    region = scipy.spatial.cKDTree(centres).query(ras)[1]
+    inside = np.linalg.norm(ras - 1000. * head_origin, axis=1) < 0.9 * 1000. * head_radius
+    seg = np.where(inside, np.where(ras[:, 0] < 0, 1001, 2001) + region, 0)
+    nib.save(nib.MGHImage(seg.reshape(shape).astype(np.int32), vox2ras), os.path.join(subjects_dir, subject, 'mri', 'aparc+aseg.mgz'))
+    # T1 on the same grid, only its geometry is used (volume source spaces)
+    nib.save(nib.MGHImage((100 * inside).reshape(shape).astype(np.uint8), vox2ras), os.path.join(subjects_dir, subject, 'mri', 'T1.mgz'))
+    return subject
+
+def _tkr_vox2ras(shape, voxel_size):
+    # FreeSurfer tkr RAS of a conformed volume: centred, LIA orientation (also used as the scanner RAS)
+    return np.array([[-voxel_size, 0., 0., voxel_size * shape[0] / 2.],
+                     [0., 0., voxel_size, -voxel_size * shape[2] / 2.],
+                     [0., -voxel_size, 0., voxel_size * shape[1] / 2.],
+                     [0., 0., 0., 1.]])
+
+def make_trans():
+    # MRI (surface RAS) coordinates are the head coordinates
+    return mne.transforms.Transform('head', 'mri', np.eye(4))